@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Generate synthetic CubeMX SW4STM32 projects, with a matching GNU ARM Eclipse project skeleton,
+to measure the performance of cubemximporter offline"""
+
+from __future__ import print_function
+import os
+import argparse
+import shutil
+
+
+LAYOUTS = ("4.13", "4.14", "4.18", "4.19")
+
+# MCU, CMSIS core header and FreeRTOS GCC port of each HAL family
+FAMILIES = {
+    "F0": ("STM32F072xB", "core_cm0.h", "ARM_CM0"),
+    "F4": ("STM32F401xE", "core_cm4.h", "ARM_CM4F"),
+    "F7": ("STM32F746xx", "core_cm7.h", "ARM_CM7/r0p1"),
+    "L4": ("STM32L476xx", "core_cm4.h", "ARM_CM4F"),
+}
+
+# HAL modules, in the order they are enabled in stm32XXxx_hal_conf.h. Modules with an extension
+# have a _ex source file too
+HAL_MODULES = [("cortex", False), ("dma", True), ("flash", True), ("gpio", True), ("pwr", True), ("rcc", True),
+               ("adc", True), ("can", False), ("crc", False), ("dac", True), ("i2c", True), ("i2s", True),
+               ("irda", False), ("iwdg", False), ("rtc", True), ("sd", False), ("smartcard", False),
+               ("spi", False), ("tim", True), ("uart", False), ("usart", False), ("wwdg", False), ("pcd", True),
+               ("hcd", False), ("sram", False), ("nand", False), ("nor", False), ("sdram", False)]
+
+# Number of HAL modules, middleware files and bytes per middleware file of each scale
+SCALES = {
+    "small": (8, 20, 512),
+    "medium": (len(HAL_MODULES), 400, 4096),
+    "huge": (len(HAL_MODULES), 4000, 16384),
+}
+
+OPTION_PREFIX = "ilg.gnuarmeclipse.managedbuild.cross.option."
+
+ECLIPSE_CONFIGURATION = """<cconfiguration id="ilg.gnuarmeclipse.managedbuild.cross.config.elf.%(id)s">
+<storageModule moduleId="cdtBuildSystem" version="4.0.0">
+<configuration artifactName="${ProjName}" name="%(name)s">
+<folderInfo id="ilg.gnuarmeclipse.managedbuild.cross.config.elf.%(id)s." name="/" resourcePath="">
+<toolChain superClass="ilg.gnuarmeclipse.managedbuild.cross.toolchain.elf">
+%(tools)s
+</toolChain>
+</folderInfo>
+<sourceEntries>
+<entry flags="VALUE_WORKSPACE_PATH|RESOLVED" kind="sourcePath" name="include"/>
+<entry flags="VALUE_WORKSPACE_PATH|RESOLVED" kind="sourcePath" name="src"/>
+<entry flags="VALUE_WORKSPACE_PATH|RESOLVED" kind="sourcePath" name="system"/>
+</sourceEntries>
+</configuration>
+</storageModule>
+</cconfiguration>
+"""
+
+SW4STM32_PROJECT = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<?fileVersion 4.0.0?><cproject storage_type_id="org.eclipse.cdt.core.XmlProjectDescriptionStorage">
+<storageModule moduleId="org.eclipse.cdt.core.settings">
+<cconfiguration id="fr.ac6.managedbuild.config.gnu.cross.exe.debug.1">
+<storageModule moduleId="cdtBuildSystem" version="4.0.0">
+<configuration name="Debug" parent="fr.ac6.managedbuild.config.gnu.cross.exe.debug">
+<option superClass="gnu.c.compiler.option.preprocessor.def.symbols" valueType="definedSymbols">
+%(defines)s
+</option>
+<option superClass="gnu.c.compiler.option.include.paths" valueType="includePath">
+%(includes)s
+</option>
+</configuration>
+</storageModule>
+</cconfiguration>
+</storageModule>
+</cproject>
+"""
+
+
+def writeFile(path, content=""):
+    """Write a file, creating its folder if needed"""
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def sourceFile(name, size):
+    """A C source file of about 'size' bytes, with a static symbol and a function named after 'name'"""
+    symbol = "".join(c if c.isalnum() else "_" for c in name)
+    lines = ["/* %s: synthetic source generated by benchmark/generate.py */" % name,
+             "static int %s_counter;" % symbol,
+             "int %s_step(int value)" % symbol, "{"]
+    body = "    %s_counter += value; /* padding */" % symbol
+    while sum(len(l) + 1 for l in lines) < size:
+        lines.append(body)
+    lines.extend(["    return %s_counter;" % symbol, "}", ""])
+    return "\n".join(lines)
+
+
+def generateEclipseProject(path, family):
+    """Generate the skeleton of a GNU ARM Eclipse project for a STM32 MCU of the given HAL family"""
+    mcu = FAMILIES[family][0]
+    hal = family.lower()
+
+    configurations = []
+    for number, (name, macro) in enumerate((("Debug", "DEBUG"), ("Release", "NDEBUG"))):
+        includes = ["../include", "../system/include", "../system/include/cmsis",
+                    "../system/include/stm32%s-hal" % hal]
+        macros = [macro, "USE_FULL_ASSERT", "TRACE", "OS_USE_TRACE_SEMIHOSTING_DEBUG", mcu, "USE_HAL_DRIVER",
+                  "HSE_VALUE=8000000"]
+        tools = []
+        for tool in ("assembler", "c.compiler", "cpp.compiler"):
+            tools.append('<tool superClass="ilg.gnuarmeclipse.managedbuild.cross.tool.%s">' % tool)
+            tools.append('<option superClass="%s%s.defs" valueType="definedSymbols">' % (OPTION_PREFIX, tool))
+            tools.extend('<listOptionValue builtIn="false" value="%s"/>' % m for m in macros)
+            tools.append('</option>')
+            tools.append('<option superClass="%s%s.include.paths" valueType="includePath">' % (OPTION_PREFIX, tool))
+            tools.extend('<listOptionValue builtIn="false" value="&quot;%s&quot;"/>' % i for i in includes)
+            tools.append('</option>')
+            tools.append('</tool>')
+        configurations.append(ECLIPSE_CONFIGURATION % {"id": 1000 + number, "name": name, "tools": "\n".join(tools)})
+
+    writeFile(os.path.join(path, ".cproject"),
+              '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<?fileVersion 4.0.0?>'
+              '<cproject storage_type_id="org.eclipse.cdt.core.XmlProjectDescriptionStorage">\n'
+              '<storageModule moduleId="org.eclipse.cdt.core.settings">\n%s</storageModule>\n</cproject>\n' %
+              "".join(configurations))
+    writeFile(os.path.join(path, ".project"), "<projectDescription><name>benchmark</name></projectDescription>\n")
+
+    writeFile(os.path.join(path, "src/main.c"), sourceFile("main", 1024))
+    writeFile(os.path.join(path, "src/_write.c"), sourceFile("_write", 512))
+    writeFile(os.path.join(path, "src/Timer.c"), sourceFile("Timer", 512))
+    writeFile(os.path.join(path, "include/Timer.h"), "#pragma once\n")
+    writeFile(os.path.join(path, "include/diag/Trace.h"), "#pragma once\n")
+    writeFile(os.path.join(path, "system/src/cmsis/system_stm32%sxx.c" % hal), sourceFile("system", 2048))
+    writeFile(os.path.join(path, "system/src/cmsis/vectors_stm32%sxx.c" % hal), sourceFile("vectors", 4096))
+    writeFile(os.path.join(path, "system/src/newlib/_startup.c"), sourceFile("_startup", 2048))
+    writeFile(os.path.join(path, "system/include/cmsis/cmsis_device.h"),
+              '#ifndef CMSIS_DEVICE_H_\n#define CMSIS_DEVICE_H_\n\n#include "stm32%sxx.h"\n\n#endif\n' % hal)
+    writeFile(os.path.join(path, "system/include/cmsis/stm32%sxx.h" % hal), "#pragma once\n")
+    writeFile(os.path.join(path, "system/include/cmsis/system_stm32%sxx.h" % hal), "#pragma once\n")
+    for module, ex in HAL_MODULES[:6]:
+        writeFile(os.path.join(path, "system/src/stm32%s-hal/stm32%sxx_hal_%s.c" % (hal, hal, module)),
+                  sourceFile(module, 1024))
+        writeFile(os.path.join(path, "system/include/stm32%s-hal/stm32%sxx_hal_%s.h" % (hal, hal, module)),
+                  "#pragma once\n")
+    writeFile(os.path.join(path, "ldscripts/mem.ld"),
+              "MEMORY\n{\n  RAM (xrw) : ORIGIN = 0x20000000, LENGTH = 96K\n"
+              "  FLASH (rx) : ORIGIN = 0x00000000, LENGTH = 512K\n}\n")
+
+
+def generateCubeMXProject(path, family, layout, halModules, middlewareFiles, middlewareSize):
+    """Generate a CubeMX SW4STM32 project with the layout of the given CubeMX release (4.13, 4.14, 4.18
+    or 4.19), using 'halModules' HAL modules, FreeRTOS, FatFs and a ST middleware made of
+    'middlewareFiles' sources of 'middlewareSize' bytes each"""
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout '%s'" % layout)
+    mcu, core, port = FAMILIES[family]
+    hal = family.lower()
+    halDir = "Drivers/STM32%sxx_HAL_Driver" % family
+    deviceDir = "Drivers/CMSIS/Device/ST/STM32%sxx" % family
+    templatesDir = deviceDir + "/Source/Templates"
+    name = "benchmark"
+
+    writeFile(os.path.join(path, ".mxproject"), "[PreviousLibFiles]\nLibFiles=\n")
+    writeFile(os.path.join(path, name + ".ioc"),
+              "Mcu.Family=STM32%s\nMcu.UserName=%s\nProjectManager.FirmwarePackage=STM32Cube FW_%s V1.16.0\n"
+              "ProjectManager.TargetToolchain=SW4STM32\n" %
+              (family, mcu, family))
+
+    includes = ["../Inc", "../%s/Inc" % halDir, "../%s/Inc/Legacy" % halDir, "../%s/Include" % deviceDir,
+                "../Drivers/CMSIS/Include", "../Middlewares/Third_Party/FreeRTOS/Source/include",
+                "../Middlewares/Third_Party/FreeRTOS/Source/CMSIS_RTOS",
+                "../Middlewares/Third_Party/FreeRTOS/Source/portable/GCC/%s" % port,
+                "../Middlewares/Third_Party/FatFs/src", "../Middlewares/ST/Benchmark/Inc"]
+    if layout == "4.13":
+        cproject = os.path.join(path, "SW4STM32", "%s Configuration" % name, ".cproject")
+        includes = ["../../../" + i[3:] for i in includes]
+        writeFile(os.path.join(os.path.dirname(cproject), ".project"), "<projectDescription/>\n")
+    else:
+        cproject = os.path.join(path, ".cproject")
+    defines = ["__weak=__attribute__((weak))", "__packed=__attribute__((__packed__))", "USE_HAL_DRIVER", mcu]
+    writeFile(cproject, SW4STM32_PROJECT % {
+        "defines": "\n".join('<listOptionValue builtIn="false" value="%s"/>' % d for d in defines),
+        "includes": "\n".join('<listOptionValue builtIn="false" value="%s"/>' % i for i in includes)})
+
+    # Application
+    writeFile(os.path.join(path, "Src/main.c"), '#include "main.h"\n#include "stm32%sxx_hal.h"\n' % hal +
+              sourceFile("main", 4096))
+    for module in ("stm32%sxx_hal_msp" % hal, "stm32%sxx_it" % hal, "freertos", "fatfs", "usb_device"):
+        writeFile(os.path.join(path, "Src/%s.c" % module), sourceFile(module, 2048))
+    for header in ("main", "stm32%sxx_it" % hal, "fatfs", "usb_device"):
+        writeFile(os.path.join(path, "Inc/%s.h" % header), "#pragma once\n")
+    enabled = HAL_MODULES[:halModules]
+    writeFile(os.path.join(path, "Inc/stm32%sxx_hal_conf.h" % hal),
+              "#define HAL_MODULE_ENABLED\n" + "".join(
+                  ("#define HAL_%s_MODULE_ENABLED\n" if (module, ex) in enabled else
+                   "/* #define HAL_%s_MODULE_ENABLED */\n") % module.upper() for module, ex in HAL_MODULES))
+    writeFile(os.path.join(path, "Inc/FreeRTOSConfig.h"), "#define USE_FreeRTOS_HEAP_4\n#define configUSE_PREEMPTION 1\n")
+    writeFile(os.path.join(path, "Inc/ffconf.h"), "#define _USE_LFN 1\n#define _CODE_PAGE 850\n")
+
+    # System and startup files moved from the CMSIS templates in CubeMX 4.18 and 4.19
+    systemFile = "system_stm32%sxx.c" % hal
+    startupFile = "startup_%s.s" % mcu.lower()
+    if layout in ("4.18", "4.19"):
+        writeFile(os.path.join(path, "Src", systemFile), sourceFile("system", 8192))
+    else:
+        writeFile(os.path.join(path, templatesDir, systemFile), sourceFile("system", 8192))
+    if layout == "4.19":
+        writeFile(os.path.join(path, "startup", startupFile), "/* startup */\n" + "  .word 0\n" * 1024)
+    else:
+        writeFile(os.path.join(path, templatesDir, "gcc", startupFile), "/* startup */\n" + "  .word 0\n" * 1024)
+    writeFile(os.path.join(path, templatesDir, "iar", startupFile), "/* startup */\n")
+
+    # HAL, with all the modules of the family, as CubeMX copies the whole driver
+    writeFile(os.path.join(path, halDir, "Src/stm32%sxx_hal.c" % hal), sourceFile("hal", 8192))
+    writeFile(os.path.join(path, halDir, "Inc/stm32%sxx_hal.h" % hal), "#pragma once\n")
+    writeFile(os.path.join(path, halDir, "Inc/stm32%sxx_hal_def.h" % hal), "#pragma once\n")
+    writeFile(os.path.join(path, halDir, "Inc/Legacy/stm32_hal_legacy.h"), "#pragma once\n")
+    for module, ex in HAL_MODULES:
+        for suffix in ("", "_ex") if ex else ("",):
+            base = "stm32%sxx_hal_%s%s" % (hal, module, suffix)
+            writeFile(os.path.join(path, halDir, "Src", base + ".c"), sourceFile(base, 16384))
+            writeFile(os.path.join(path, halDir, "Inc", base + ".h"), "#pragma once\n" + "/* */\n" * 256)
+    for ll in ("sdmmc", "fmc", "fsmc", "usb"):
+        writeFile(os.path.join(path, halDir, "Src/stm32%sxx_ll_%s.c" % (hal, ll)), sourceFile(ll, 8192))
+        writeFile(os.path.join(path, halDir, "Inc/stm32%sxx_ll_%s.h" % (hal, ll)), "#pragma once\n")
+    for template in ("msp_template", "timebase_tim_template", "conf_template"):
+        writeFile(os.path.join(path, halDir, "Src/stm32%sxx_hal_%s.c" % (hal, template)), sourceFile(template, 1024))
+
+    # CMSIS
+    writeFile(os.path.join(path, "Drivers/CMSIS/Include", core), "#pragma once\n" + "/* */\n" * 1024)
+    writeFile(os.path.join(path, "Drivers/CMSIS/Include/cmsis_gcc.h"), "#pragma once\n")
+    writeFile(os.path.join(path, deviceDir, "Include/stm32%sxx.h" % hal), "#pragma once\n")
+    writeFile(os.path.join(path, deviceDir, "Include/system_stm32%sxx.h" % hal), "#pragma once\n")
+    writeFile(os.path.join(path, deviceDir, "Include/%s.h" % mcu.lower()), "#pragma once\n" + "/* */\n" * 8192)
+
+    # Middlewares
+    freertos = "Middlewares/Third_Party/FreeRTOS/Source"
+    for source in ("tasks.c", "queue.c", "list.c", "timers.c", "event_groups.c", "croutine.c",
+                   "CMSIS_RTOS/cmsis_os.c"):
+        writeFile(os.path.join(path, freertos, source), sourceFile(os.path.basename(source), 16384))
+    for header in ("FreeRTOS.h", "task.h", "queue.h", "list.h", "portable.h"):
+        writeFile(os.path.join(path, freertos, "include", header), "#pragma once\n")
+    for heap in range(1, 6):
+        writeFile(os.path.join(path, freertos, "portable/MemMang/heap_%d.c" % heap), sourceFile("heap", 4096))
+    for gccPort in ("ARM_CM0", "ARM_CM3", "ARM_CM4F", "ARM_CM7/r0p1"):
+        writeFile(os.path.join(path, freertos, "portable/GCC", gccPort, "port.c"), sourceFile("port", 8192))
+        writeFile(os.path.join(path, freertos, "portable/GCC", gccPort, "portmacro.h"), "#pragma once\n")
+    writeFile(os.path.join(path, freertos, "portable/IAR/ARM_CM4F/port.c"), sourceFile("port", 8192))
+
+    fatfs = "Middlewares/Third_Party/FatFs/src"
+    for source in ("ff.c", "diskio.c", "ff_gen_drv.c", "option/syscall.c", "option/unicode.c",
+                   "option/ccsbcs.c", "option/cc932.c", "option/cc936.c", "option/cc949.c", "option/cc950.c"):
+        writeFile(os.path.join(path, fatfs, source), sourceFile(os.path.basename(source), 8192))
+    for header in ("ff.h", "diskio.h", "integer.h"):
+        writeFile(os.path.join(path, fatfs, header), "#pragma once\n")
+
+    # A ST middleware (e.g. USB device library) of configurable size
+    for number in range(middlewareFiles):
+        folder = "Middlewares/ST/Benchmark/Class%d" % (number // 50)
+        writeFile(os.path.join(path, folder, "Src/module%d.c" % number), sourceFile("module%d" % number,
+                                                                                   middlewareSize))
+        if number % 5 == 0:
+            writeFile(os.path.join(path, folder, "Inc/module%d.h" % number), "#pragma once\n")
+    writeFile(os.path.join(path, "Middlewares/ST/Benchmark/Inc/benchmark.h"), "#pragma once\n")
+
+
+def generate(path, family="F4", layout="4.19", scale="small", middlewareFiles=None, middlewareSize=None):
+    """Generate a benchmark case inside 'path': the Eclipse project in 'eclipse' and the CubeMX one in 'cubemx'.
+    'middlewareFiles' and 'middlewareSize' override the ones of the scale. Returns the two paths"""
+    halModules, files, size = SCALES[scale]
+    eclipsePath = os.path.join(path, "eclipse")
+    cubemxPath = os.path.join(path, "cubemx")
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    generateEclipseProject(eclipsePath, family)
+    generateCubeMXProject(cubemxPath, family, layout, halModules,
+                          files if middlewareFiles is None else middlewareFiles,
+                          size if middlewareSize is None else middlewareSize)
+    return eclipsePath, cubemxPath
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic CubeMX project and the GNU ARM Eclipse '
+                                                 'project to import it into')
+
+    parser.add_argument('path', metavar='dest_path', type=str,
+                        help="destination folder, replaced if it exists")
+
+    parser.add_argument('--family', choices=sorted(FAMILIES), default="F4",
+                        help="HAL family of the MCU (default: F4)")
+
+    parser.add_argument('--layout', choices=LAYOUTS, default="4.19",
+                        help="CubeMX release whose project layout is generated (default: 4.19)")
+
+    parser.add_argument('--scale', choices=sorted(SCALES), default="small",
+                        help="Number of HAL modules and size of the middleware (default: small)")
+
+    parser.add_argument('--middleware-files', type=int, default=None,
+                        help="Number of sources of the synthetic ST middleware, overriding the scale")
+
+    parser.add_argument('--middleware-size', type=int, default=None,
+                        help="Size in bytes of each source of the synthetic ST middleware, overriding the scale")
+
+    args = parser.parse_args()
+
+    eclipsePath, cubemxPath = generate(args.path, args.family, args.layout, args.scale, args.middleware_files,
+                                       args.middleware_size)
+    print("Generated %s <- %s" % (eclipsePath, cubemxPath))
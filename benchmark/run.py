@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the import phases and the end-to-end command line of cubemximporter on synthetic projects
+made by generate.py, storing the results as JSON and comparing them with previous runs"""
+
+from __future__ import print_function
+import os
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cubemximporter
+import generate
+
+
+SCRIPT = os.path.abspath(cubemximporter.__file__).replace(".pyc", ".py")
+
+# Phase times include the time spent applying the operations the phase planned. Results without it
+# have the I/O of every phase accounted to executePlan, and their phases can't be compared
+PHASE_TIMES = "applied"
+
+
+def resetEclipseProject(eclipsePath, family):
+    """Replace the Eclipse project with a fresh skeleton, as created by the GNU ARM Eclipse plugin"""
+    shutil.rmtree(eclipsePath)
+    generate.generateEclipseProject(eclipsePath, family)
+
+
+def runInProcess(eclipsePath, cubemxPath, jobs):
+    """Run importProject() returning its ImportStats as a dict, with the end-to-end time in 'importProject'"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")  # Hide the banners printed by the importer
+    try:
+        start = time.time()
+        stats = cubemximporter.importProject(eclipsePath, cubemxPath, jobs=jobs).stats.toDict()
+        stats["importProject"] = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return stats
+
+
+def runCommandLine(eclipsePath, cubemxPath, jobs):
+    """Run the importer in a new interpreter, returning its wall time including the interpreter start-up"""
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        subprocess.check_call([sys.executable, SCRIPT, "-j", str(jobs), eclipsePath, cubemxPath], stdout=devnull)
+        return time.time() - start
+
+
+def runCase(workdir, family, layout, scale, repeat, jobs):
+    """Generate a benchmark case and import it 'repeat' times, keeping the best time of every measure"""
+    eclipsePath, cubemxPath = generate.generate(os.path.join(workdir, "%s-%s-%s" % (family, layout, scale)),
+                                                family, layout, scale)
+    result = {"phases": {}, "importProject": None, "cli": None}
+    for i in range(repeat):
+        resetEclipseProject(eclipsePath, family)
+        stats = runInProcess(eclipsePath, cubemxPath, jobs)
+        for phase in stats["phases"]:
+            best = result["phases"].get(phase["phase"])
+            result["phases"][phase["phase"]] = phase["seconds"] if best is None else min(best, phase["seconds"])
+        result["importProject"] = min(result["importProject"] or stats["importProject"], stats["importProject"])
+        result["filesCopied"] = stats["total"]["filesCopied"]
+        result["bytesCopied"] = stats["total"]["bytesCopied"]
+
+        resetEclipseProject(eclipsePath, family)
+        cli = runCommandLine(eclipsePath, cubemxPath, jobs)
+        result["cli"] = min(result["cli"] or cli, cli)
+    shutil.rmtree(os.path.dirname(eclipsePath))
+    return result
+
+
+def measures(case):
+    """Flatten the times of a case as (name, seconds) pairs"""
+    return [("cli", case["cli"]), ("importProject", case["importProject"])] + sorted(case["phases"].items())
+
+
+def printResults(results):
+    for name in sorted(results["cases"]):
+        case = results["cases"][name]
+        print("%s: %d files, %d bytes copied" % (name, case["filesCopied"], case["bytesCopied"]))
+        for measure, seconds in measures(case):
+            print("  %-34s %10.4fs" % (measure, seconds))
+
+
+def compareResults(baseline, results, threshold):
+    """Print the ratio between the current and the baseline times, returning the number of regressions:
+    measures slower than the baseline by more than 'threshold' (e.g. 0.1 for 10%)"""
+    regressions = 0
+    comparePhases = baseline.get("phaseTimes") == PHASE_TIMES
+    if not comparePhases:
+        print("The baseline accounts the time applying the operations to executePlan: comparing only "
+              "the end-to-end times")
+    for name in sorted(results["cases"]):
+        if name not in baseline["cases"]:
+            print("%s: not in the baseline" % name)
+            continue
+        print(name)
+        before = dict(measures(baseline["cases"][name]))
+        for measure, seconds in measures(results["cases"][name]):
+            if not before.get(measure) or (not comparePhases and measure not in ("cli", "importProject")):
+                continue
+            ratio = seconds / before[measure]
+            # Phases faster than a millisecond are too noisy to be compared
+            slower = ratio > 1 + threshold and seconds > 0.001
+            regressions += slower
+            print("  %-34s %10.4fs %10.4fs %7.2fx%s" % (measure, before[measure], seconds, ratio,
+                                                       "  SLOWER" if slower else ""))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark cubemximporter on synthetic projects')
+
+    parser.add_argument('--scales', nargs='+', choices=sorted(generate.SCALES), default=["small", "medium"],
+                        help="Project sizes to benchmark (default: small medium)")
+
+    parser.add_argument('--families', nargs='+', choices=sorted(generate.FAMILIES), default=["F4"],
+                        help="HAL families to benchmark (default: F4)")
+
+    parser.add_argument('--layouts', nargs='+', choices=generate.LAYOUTS, default=["4.19"],
+                        help="CubeMX project layouts to benchmark (default: 4.19)")
+
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of imports of every case, the best time is kept (default: 3)")
+
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help="Number of files copied in parallel by the importer (default: 4)")
+
+    parser.add_argument('--workdir', type=str, default=None,
+                        help="Folder where the cases are generated (default: a temporary folder)")
+
+    parser.add_argument('--output', metavar='FILE', type=str,
+                        help="Write the results as JSON to FILE")
+
+    parser.add_argument('--compare', metavar='FILE', type=str,
+                        help="Compare the results with the ones saved in FILE, exiting with 1 on regressions")
+
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Slowdown ratio reported as a regression by --compare (default: 0.1)")
+
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cubemximporter-benchmark-")
+    results = {"python": platform.python_version(), "platform": platform.platform(), "jobs": args.jobs,
+               "repeat": args.repeat, "phaseTimes": PHASE_TIMES, "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "cases": {}}
+    try:
+        for scale in args.scales:
+            for family in args.families:
+                for layout in args.layouts:
+                    name = "%s-%s-%s" % (family, layout, scale)
+                    print("Running %s..." % name)
+                    results["cases"][name] = runCase(workdir, family, layout, scale, args.repeat, args.jobs)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    printResults(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compareResults(json.load(f), results, args.threshold)
+        print("%d regressions" % regressions)
+        sys.exit(1 if regressions else 0)
@@ -25,46 +25,2447 @@ from __future__ import print_function
 version = '0.2.3' # using semantic versioning 2.0 model, denote a patch change
 
 import os
+import posixpath
 import argparse
+import contextlib
 import copy
+import errno
+import hashlib
+import json
 import logging
 import shutil
 import re
-from lxml import etree
+import sys
+import threading
+import time
+import filecmp
+import fnmatch
+import importlib
+import mmap
+import select
+import struct
+
+
+class LazyModule(object):
+    """A module imported on its first use, so that the paths not needing it (e.g. --check and --help)
+    start quickly"""
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__()
+
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+etree = LazyModule("lxml.etree")
+tempfile = LazyModule("tempfile")
+multiprocessing = LazyModule("multiprocessing")
+
+
+def writeIfChanged(path, content):
+    """Atomically write 'content' to 'path', unless the file already holds it. Returns True if written"""
+    content = content.encode("UTF-8")
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            if f.read() == content:
+                return False
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "wb") as f:
+        f.write(content)
+    replaceFile(tmpPath, path)
+    return True
+
+
+def replaceFile(src, dst):
+    """Atomically replace 'dst' file with 'src'"""
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:  # Python 2: rename() replaces the destination on POSIX only
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class CopyEngine(object):
+    """Runs file copies on a bounded pool of worker threads"""
+
+    LINK_MODES = ("copy", "hardlink", "reflink", "symlink")
+    FICLONE = 0x40049409  # Linux ioctl used to share the extents of two files on CoW filesystems
+
+    def __init__(self, jobs=1, linkMode="copy"):
+        super(CopyEngine, self).__init__()
+
+        self.linkMode = linkMode
+        self.unsupportedDevices = set()
+        self.jobs = max(1, jobs)
+        self.pool = None
+        if self.jobs > 1:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(self.jobs)
+        self.pending = []
+        self.maxPending = self.jobs * 64
+        self.lock = threading.Lock()
+        self.filesCopied = 0
+        self.bytesCopied = 0
+        self.filesSkipped = 0
+
+    def _run(self, func, args):
+        copied = func(*args)
+        with self.lock:
+            if copied is None:
+                self.filesSkipped += 1
+            else:
+                self.filesCopied += 1
+                self.bytesCopied += copied
+
+    def submit(self, func, *args):
+        """Schedule a copy job. 'func' returns the number of bytes copied, or None if the file was skipped"""
+        if self.pool is None:
+            self._run(func, args)
+            return
+
+        if len(self.pending) >= self.maxPending:
+            self.pending.pop(0).get()  # Throttle the producer and surface errors early
+        self.pending.append(self.pool.apply_async(self._run, (func, args)))
+
+    def wait(self):
+        """Wait for all scheduled jobs to complete, raising the first error occurred"""
+        pending, self.pending = self.pending, []
+        error = None
+        for result in pending:
+            try:
+                result.get()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def close(self):
+        """Wait for pending jobs and release the worker threads"""
+        try:
+            self.wait()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def materialize(self, src, dst, link=False, metadata=False, mode=None):
+        """Create 'dst' with the content of 'src', using the configured link mode (or 'mode', if given)
+        if 'link' is True. Falls back to a plain copy when the filesystem doesn't support the link mode"""
+        if os.path.lexists(dst):
+            # Never write through a link created by a previous import
+            os.unlink(dst)
+
+        mode = (mode or self.linkMode) if link else "copy"
+        if mode != "copy":
+            device = os.stat(os.path.dirname(os.path.abspath(src))).st_dev
+            if device not in self.unsupportedDevices:
+                try:
+                    self._link(src, dst, mode)
+                    return 0
+                except (OSError, IOError, AttributeError, ImportError) as e:
+                    logging.debug("Unable to %s %s (%s): falling back to copy" % (mode, src, e))
+                    with self.lock:
+                        self.unsupportedDevices.add(device)
+                    if os.path.lexists(dst):
+                        os.unlink(dst)
+
+        if metadata:
+            shutil.copy2(src, dst)
+        else:
+            shutil.copyfile(src, dst)
+        return os.path.getsize(dst)
+
+    def _link(self, src, dst, mode):
+        if mode == "hardlink":
+            os.link(src, dst)
+        elif mode == "symlink":
+            os.symlink(os.path.abspath(src), dst)
+        elif mode == "reflink":
+            import fcntl
+            with open(src, "rb") as fsrc:
+                with open(dst, "wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+        else:
+            raise ValueError("Unknown link mode '%s'" % mode)
+
+    def summary(self):
+        return "Copied %d files (%d bytes), %d files skipped" % (self.filesCopied, self.bytesCopied,
+                                                                self.filesSkipped)
+
+
+class PatchRule(object):
+    """A regex substitution applied to the lines of the files whose project relative path matches 'glob'
+    (fnmatch syntax). If 'when' is given, only the lines matching it are patched. 'literal' is a string
+    every patched line contains: files without it are skipped without being read line by line"""
+
+    def __init__(self, glob, pattern, replacement, when=None, literal=None, description=""):
+        super(PatchRule, self).__init__()
+
+        self.glob = glob
+        self.regex = re.compile(pattern.encode("UTF-8"))
+        self.replacement = replacement.encode("UTF-8")
+        self.when = re.compile(when.encode("UTF-8")) if when is not None else None
+        self.literal = literal.encode("UTF-8") if literal is not None else None
+        self.description = description or "Patched %s" % glob
+
+    def apply(self, line):
+        if self.literal is not None and self.literal not in line:
+            return line
+        if self.when is not None and not self.when.search(line):
+            return line
+        return self.regex.sub(self.replacement, line)
+
+
+class PatchSet(object):
+    """A set of PatchRules applied to the matching files in a single streaming pass per file"""
+
+    def __init__(self, rules=()):
+        super(PatchSet, self).__init__()
+
+        self.rules = list(rules)
+
+    def files(self, root):
+        """List the (path, rules) pairs of the files inside 'root' matched by the rules"""
+        matched = {}
+        patterns = [rule for rule in self.rules if any(c in rule.glob for c in "*?[")]
+        if patterns:
+            for rootdir, dirs, files in os.walk(root):
+                for f in files:
+                    relPath = os.path.relpath(os.path.join(rootdir, f), root).replace(os.sep, "/")
+                    for rule in patterns:
+                        if fnmatch.fnmatchcase(relPath, rule.glob):
+                            matched.setdefault(relPath, set()).add(rule)
+        for rule in self.rules:
+            if rule not in patterns and os.path.isfile(os.path.join(root, rule.glob)):
+                matched.setdefault(rule.glob, set()).add(rule)
+
+        return [(os.path.join(root, relPath), [rule for rule in self.rules if rule in matched[relPath]])
+                for relPath in sorted(matched)]
+
+    @staticmethod
+    def contains(path, literals):
+        """Search any of the literals inside a file, through mmap"""
+        if os.path.getsize(path) == 0:
+            return False
+        with open(path, "rb") as f:
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return any(content.find(literal) >= 0 for literal in literals)
+            finally:
+                content.close()
+
+    def patchFile(self, path, rules):
+        """Apply the rules to the file, replacing it atomically only if its content changes.
+        Returns the rules that changed it"""
+        literals = [rule.literal for rule in rules]
+        if None not in literals and not self.contains(path, literals):
+            return []
+
+        applied = []
+        unchanged = []  # Lines read before the first change, written only if the file changes
+        out = None
+        tmpPath = None
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    for rule in rules:
+                        patched = rule.apply(line)
+                        if patched != line:
+                            line = patched
+                            if rule not in applied:
+                                applied.append(rule)
+                    if out is None and applied:
+                        fd, tmpPath = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp",
+                                                       dir=os.path.dirname(path))
+                        out = os.fdopen(fd, "wb")
+                        out.writelines(unchanged)
+                    if out is not None:
+                        out.write(line)
+                    else:
+                        unchanged.append(line)
+            if out is not None:
+                out.close()
+                shutil.copymode(path, tmpPath)
+                replaceFile(tmpPath, path)
+        except:
+            if out is not None:
+                out.close()
+                os.remove(tmpPath)
+            raise
+        return applied
+
+
+class Operation(object):
+    """An operation on the Eclipse project planned by an import phase"""
+
+    kind = None
+    phase = None  # Name of the import phase that planned the operation
+
+    def __init__(self):
+        super(Operation, self).__init__()
+
+        self.files = 0  # Number of files written or deleted
+        self.bytes = 0  # Number of bytes written or deleted
+
+    def describe(self):
+        raise NotImplementedError
+
+    def apply(self, importer):
+        raise NotImplementedError
+
+
+class CopyOperation(Operation):
+    """Copy (or link) a file inside the Eclipse project"""
+
+    kind = "copy"
+
+    def __init__(self, src, dst, link=False, metadata=False, size=None):
+        super(CopyOperation, self).__init__()
+
+        self.src = src
+        self.dst = dst
+        self.link = link
+        self.metadata = metadata
+        self.unchanged = False  # Set when the destination already holds the same file
+        self.files = 1
+        self.bytes = os.path.getsize(src) if size is None else size
+
+    def describe(self):
+        action = "keep" if self.unchanged else ("link" if self.link else "copy")
+        return "%-10s %s -> %s" % (action, self.src, self.dst)
+
+    def isSatisfied(self, importer):
+        """Check if the destination file already is what this operation would create"""
+        if not os.path.lexists(self.dst) or (self.link and importer.store is not None):
+            return False
+        if importer.sources.isArchived(self.src):  # Files inside archives can only be copied
+            return not os.path.islink(self.dst) and importer.sources.sameContent(self.src, self.dst)
+
+        mode = importer.copier.linkMode if self.link else "copy"
+        if mode == "symlink":
+            return os.path.islink(self.dst) and os.path.realpath(self.dst) == os.path.realpath(self.src)
+        if mode == "hardlink":
+            return not os.path.islink(self.dst) and os.path.samefile(self.src, self.dst)
+        if mode == "copy":
+            return not os.path.islink(self.dst) and not os.path.samefile(self.src, self.dst) and \
+                filecmp.cmp(self.src, self.dst)
+        return False  # There is no way to tell if two files share their extents
+
+    def apply(self, importer):
+        importer.copier.submit(importer.executeCopy, self)
+
+
+class DeleteOperation(Operation):
+    """Delete a file, or a folder with all its content except the files in 'keep'"""
+
+    kind = "delete"
+
+    def __init__(self, path):
+        super(DeleteOperation, self).__init__()
+
+        self.path = path
+        self.keep = set()
+        self.sizes = {}
+
+        if os.path.isdir(path) and not os.path.islink(path):
+            for rootdir, dirs, files in os.walk(path):
+                for f in files:
+                    self.sizes[os.path.join(rootdir, f)] = os.path.getsize(os.path.join(rootdir, f))
+        elif os.path.lexists(path):
+            self.sizes[path] = os.path.getsize(path)
+        self.updateCost()
+
+    def updateCost(self):
+        self.files = len(self.sizes) - len(self.keep)
+        self.bytes = sum(size for f, size in self.sizes.items() if f not in self.keep)
+
+    def describe(self):
+        kept = " (keeping %d unchanged files)" % len(self.keep) if self.keep else ""
+        return "%-10s %s%s" % ("delete", self.path, kept)
+
+    def apply(self, importer):
+        if not os.path.lexists(self.path):
+            return
+        if not os.path.isdir(self.path) or os.path.islink(self.path):
+            os.unlink(self.path)
+        elif not self.keep:
+            shutil.rmtree(self.path)
+        else:
+            for rootdir, dirs, files in os.walk(self.path, topdown=False):
+                for f in files:
+                    if os.path.join(rootdir, f) not in self.keep:
+                        os.unlink(os.path.join(rootdir, f))
+                if not os.listdir(rootdir):
+                    os.rmdir(rootdir)
+
+
+class MkdirOperation(Operation):
+    """Create a folder, if it doesn't exist"""
+
+    kind = "mkdir"
+
+    def __init__(self, path):
+        super(MkdirOperation, self).__init__()
+
+        self.path = path
+
+    def describe(self):
+        return "%-10s %s" % ("mkdir", self.path)
+
+    def apply(self, importer):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+
+class TextPatchOperation(Operation):
+    """Patch the Eclipse project files matched by a PatchSet. Files are resolved when the operation
+    is applied, so that the ones copied by the import can be patched too"""
+
+    kind = "text-patch"
+
+    def __init__(self, patchSet, root):
+        super(TextPatchOperation, self).__init__()
+
+        self.patchSet = patchSet
+        self.root = root
+        self.updateCost()
+
+    def updateCost(self):
+        # Only the files already in the Eclipse project can be estimated
+        paths = [path for path, rules in self.patchSet.files(self.root)]
+        self.files = len(paths)
+        self.bytes = sum(os.path.getsize(path) for path in paths)
+
+    def merge(self, other):
+        """Add the rules of another TextPatchOperation, so that each file is patched in a single pass"""
+        self.patchSet.rules.extend(other.patchSet.rules)
+        self.updateCost()
+
+    def describe(self):
+        return "%-10s %s" % ("patch", ", ".join("%s (%s)" % (rule.glob, rule.description)
+                                                 for rule in self.patchSet.rules))
+
+    def apply(self, importer):
+        for path, rules in self.patchSet.files(self.root):
+            for rule in self.patchSet.patchFile(path, rules):
+                importer.logger.info(rule.description)
+
+
+class XmlEditOperation(Operation):
+    """Apply a batch of EclipseProjectEdits to the Eclipse project DOM"""
+
+    kind = "xml-edit"
+
+    def __init__(self, edits):
+        super(XmlEditOperation, self).__init__()
+
+        self.edits = edits
+
+    def describe(self):
+        return "%-10s .cproject: %d option values, %d source entries, %d build exclusions" % (
+            "edit", sum(len(values) for superClass, values, quote in self.edits.optionValues) +
+            sum(len(values) for superClass, values, configuration in self.edits.optionLists),
+            len(self.edits.sourceEntries), len(self.edits.buildExclusions))
+
+    def apply(self, importer):
+        for superClass, values, quote in self.edits.optionValues:
+            importer.projectOptions.addOptionValues(superClass, values, quote)
+        for superClass, values, configuration in self.edits.optionLists:
+            importer.projectOptions.setOptionValues(superClass, values, configuration)
+        importer.projectOptions.addSourceEntries(self.edits.sourceEntries)
+        for path, excluded in self.edits.buildExclusions:
+            importer.projectOptions.setExcludedFromBuild(path, excluded)
+
+
+class XmlWriteOperation(Operation):
+    """Write the Eclipse project DOM to the .cproject file"""
+
+    kind = "xml-write"
+
+    def __init__(self, path):
+        super(XmlWriteOperation, self).__init__()
+
+        self.path = path
+        self.files = 1
+
+    def describe(self):
+        return "%-10s %s" % ("write", self.path)
+
+    def apply(self, importer):
+        importer.writeEclipseProjectFile()
+
+
+class UnityBuildOperation(Operation):
+    """Group the HAL and middleware sources in unity files, excluding the grouped ones from the build.
+    It runs once the files are copied and the other .cproject edits are applied, because it reads both"""
+
+    kind = "unity-build"
+
+    def __init__(self, root, batches):
+        super(UnityBuildOperation, self).__init__()
+
+        self.root = root
+        self.batches = batches
+
+    def describe(self):
+        if not self.batches:
+            return "%-10s %s (removing unity files)" % ("unity", os.path.join(self.root, UnityBuild.FOLDER))
+        return "%-10s %s (%d batches for the HAL and each middleware)" % (
+            "unity", os.path.join(self.root, UnityBuild.FOLDER), self.batches)
+
+    def apply(self, importer):
+        unity = UnityBuild(self.root, importer.HAL_TYPE, self.batches)
+
+        # Sources grouped by a previous import are built again, unless excluded by this import
+        excluded = {}
+        for op in importer.plan.operations:
+            if op.kind == "xml-edit":
+                excluded.update(op.edits.buildExclusions)
+        XmlEditOperation(EclipseProjectEdits().includeInBuild(
+            [path for path in unity.previousSources() if not excluded.get(path)])).apply(importer)
+
+        written = []
+        if self.batches:
+            grouped = []
+            sources = BuildDescription(importer.projectRoot, self.root, importer.HAL_TYPE).sources
+            for name, files in unity.groups(sources):
+                batches, collisions, alone = unity.split(files)
+                for number, members in enumerate(batches):
+                    written.append(unity.writeUnityFile("unity_%s_%d.c" % (name, number + 1), members))
+                    grouped.extend(members)
+                if collisions:
+                    importer.logger.info("Not grouped in the %s unity files, as they define the same static symbols "
+                                         "or macros as other sources: %s" % (name, ", ".join(
+                                             os.path.basename(f) for f in collisions)))
+                if alone:
+                    importer.logger.info("Not grouped in the %s unity files, as they are too few: %s" % (
+                        name, ", ".join(os.path.basename(f) for f in alone)))
+            XmlEditOperation(EclipseProjectEdits().excludeFromBuild(grouped)).apply(importer)
+            importer.logger.info("Grouped %d sources in %d unity files" % (len(grouped), len(written)))
+        unity.removeUnityFiles(keep=written)
+
+
+class IncludePathsOperation(Operation):
+    """Reduce the include paths of every tool to the ones needed by the sources of the Eclipse project,
+    printing the unused ones. If disabled, the include paths removed by a previous import are restored"""
+
+    kind = "include-scan"
+
+    def __init__(self, root, enabled):
+        super(IncludePathsOperation, self).__init__()
+
+        self.root = root
+        self.enabled = enabled
+
+    def describe(self):
+        action = "removing unused include paths" if self.enabled else "restoring the removed include paths"
+        return "%-10s %s (%s)" % ("includes", os.path.join(self.root, ".cproject"), action)
+
+    def apply(self, importer):
+        scanner = IncludeScanner(self.root)
+        edits = EclipseProjectEdits()
+        report = []
+        for configuration in importer.projectRoot.iter("configuration"):
+            name = configuration.attrib.get("name", "")
+            build = BuildDescription(importer.projectRoot, self.root, importer.HAL_TYPE, name)
+            for tool in EclipseProjectEdits.TOOLS:
+                includes = scanner.candidates(name, tool, build.option(tool + ".include.paths"))
+                if includes is None:
+                    continue
+                sources = [s for s in build.sources if BuildDescription.TOOLS[os.path.splitext(s)[1]] == tool]
+                if self.enabled and sources:  # Tools without sources are left alone, e.g. C++ in a C project
+                    used = scanner.usedIncludes(name, tool, sources, includes, build.projectPath)
+                    unused = [i for i in includes if i not in used]
+                    if unused:
+                        report.append("  %s, %s: %s" % (name, tool, ", ".join(i.strip('"') for i in unused)))
+                else:
+                    used = includes
+                edits.setIncludes(used, (tool,), name)
+        XmlEditOperation(edits).apply(importer)
+
+        if self.enabled:
+            scanner.save()
+            importer.logger.info("Scanned the includes of %d files (%d parsed again)" % (
+                len(scanner.directives), scanner.parsed))
+            if report:
+                print("Include paths not needed by the sources, removed from the Eclipse project:")
+                print("\n".join(report))
+        else:
+            scanner.remove()
+
+
+class BuildFilesOperation(Operation):
+    """Generate build.ninja, CMakeLists.txt and compile_commands.json from the Eclipse project settings.
+    If disabled, the files generated by a previous import are removed"""
+
+    kind = "build-files"
+
+    def __init__(self, root, enabled=True):
+        super(BuildFilesOperation, self).__init__()
+
+        self.root = root
+        self.enabled = enabled
+        self.files = len(BuildDescription.OUTPUTS)
+
+    @staticmethod
+    def generated(root):
+        """The build files in 'root' generated by a previous import. compile_commands.json has no room for a
+        marker, so it is recognized only next to a generated build.ninja or CMakeLists.txt"""
+        found = []
+        for name in BuildDescription.OUTPUTS[:2]:
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    if f.readline().startswith(b"# Generated by cubemximporter"):
+                        found.append(name)
+        if found and os.path.isfile(os.path.join(root, BuildDescription.OUTPUTS[2])):
+            found.append(BuildDescription.OUTPUTS[2])
+        return found
+
+    def describe(self):
+        if not self.enabled:
+            return "%-10s %s (removing generated build files)" % ("generate", self.root)
+        return "%-10s %s" % ("generate", ", ".join(os.path.join(self.root, f) for f in BuildDescription.OUTPUTS))
+
+    def apply(self, importer):
+        if not self.enabled:
+            for name in self.generated(self.root):
+                os.remove(os.path.join(self.root, name))
+                importer.logger.info("Removed %s" % name)
+            return
+
+        build = BuildDescription(importer.projectRoot, self.root, importer.HAL_TYPE)
+        for name, content in zip(BuildDescription.OUTPUTS, (build.ninja(), build.cmake(), build.compileCommands())):
+            if writeIfChanged(os.path.join(self.root, name), content):
+                importer.logger.info("Generated %s" % name)
+
+
+class ImportPlan(object):
+    """The list of operations planned by the import phases, applied all together by CubeMXImporter.executePlan()"""
+
+    # Operations are applied in this order, so that copies run all together on the copy engine
+    ORDER = ("delete", "mkdir", "copy", "text-patch", "xml-edit", "unity-build", "include-scan", "xml-write",
+             "build-files")
+
+    def __init__(self):
+        super(ImportPlan, self).__init__()
+
+        self.operations = []
+        self.deleted = set()
+        self.phase = None  # Name of the import phase currently planning operations
+
+    def add(self, operation):
+        operation.phase = self.phase
+        self.operations.append(operation)
+        if operation.kind == "delete":
+            self.deleted.add(os.path.normpath(operation.path))
+
+    def willExist(self, path):
+        """Check if 'path' will still exist once the deletions planned so far are applied"""
+        path = os.path.normpath(path)
+        parent = path
+        while True:
+            if parent in self.deleted:
+                return False
+            parent, tail = os.path.split(parent)
+            if not tail:
+                return os.path.exists(path)
+
+    def optimize(self, importer):
+        """Sort operations by kind (and copies by their position inside source archives), coalesce the deletions
+        of files copied again with the same content and merge all text patches"""
+        self.operations.sort(key=lambda op: (self.ORDER.index(op.kind),
+                                             importer.sources.position(op.src) if op.kind == "copy" else ("", 0)))
+
+        copies = dict((os.path.normpath(op.dst), op) for op in self.operations if op.kind == "copy")
+        for op in [op for op in self.operations if op.kind == "delete"]:
+            for path in op.sizes:
+                copy = copies.get(os.path.normpath(path))
+                if copy is not None and copy.isSatisfied(importer):
+                    copy.unchanged = True
+                    op.keep.add(path)
+            op.updateCost()
+            if op.sizes and op.files == 0 and not os.path.isdir(op.path):
+                self.operations.remove(op)
+
+        if importer.incremental:
+            # The copies the previous import proves up to date are skipped, so that dry runs tell the real cost
+            for copy in copies.values():
+                if not copy.unchanged and self.willExist(copy.dst) and importer.manifest.isUpToDate(
+                        importer.manifestKey(copy.dst), copy.src, copy.dst, mode=importer.copyMode(copy),
+                        record=False):
+                    copy.unchanged = True
+
+        patches = [op for op in self.operations if op.kind == "text-patch"]
+        for op in patches[1:]:
+            patches[0].merge(op)
+            self.operations.remove(op)
+
+    def cost(self):
+        """Compute the number of operations, files and bytes for each kind of operation"""
+        cost = dict((kind, [0, 0, 0]) for kind in self.ORDER)
+        for op in self.operations:
+            if op.kind == "copy" and op.unchanged:
+                continue
+            cost[op.kind][0] += 1
+            cost[op.kind][1] += op.files
+            cost[op.kind][2] += op.bytes
+        return cost
+
+    def describe(self):
+        lines = [op.describe() for op in self.operations]
+        cost = self.cost()
+        kept = len([op for op in self.operations if op.kind == "copy" and op.unchanged])
+        lines.append("Plan: %d operations, %d unchanged files kept" % (len(self.operations) - kept, kept))
+        for kind in self.ORDER:
+            operations, files, size = cost[kind]
+            if operations:
+                lines.append("  %-10s %6d operations %8d files %12d bytes" % (kind, operations, files, size))
+        return "\n".join(lines)
+
+
+class ImportStats(object):
+    """Wall time and I/O counters of each import phase. Operations, and the time spent applying them, are
+    accounted to the phase that planned them, even if they are applied later by CubeMXImporter.executePlan()"""
+
+    COUNTERS = ("seconds", "filesCopied", "bytesCopied", "filesDeleted", "bytesDeleted", "queries", "nodesAdded")
+    HEADERS = ("seconds", "files copied", "bytes copied", "files deleted", "bytes deleted", "queries", "nodes added")
+
+    def __init__(self):
+        super(ImportStats, self).__init__()
+
+        self.phases = []  # Phase names, in the order they first run
+        self.counters = {}
+        self.lock = threading.Lock()  # Copies are accounted by the copy engine threads
+
+    def add(self, phase, counter, value):
+        with self.lock:
+            if phase not in self.counters:
+                self.phases.append(phase)
+                self.counters[phase] = dict((c, 0) for c in self.COUNTERS)
+            self.counters[phase][counter] += value
+
+    def totals(self):
+        return dict((c, sum(self.counters[p][c] for p in self.phases)) for c in self.COUNTERS)
+
+    def toDict(self):
+        """The counters as a JSON serializable dict"""
+        phases = []
+        for phase in self.phases:
+            entry = dict(self.counters[phase])
+            entry["phase"] = phase
+            phases.append(entry)
+        return {"phases": phases, "total": self.totals()}
+
+    def table(self):
+        """The counters as a human readable table"""
+        lines = ["%-34s" % "phase" + "".join("%15s" % h for h in self.HEADERS)]
+        for phase, counters in [(p, self.counters[p]) for p in self.phases] + [("total", self.totals())]:
+            lines.append("%-34s%15.3f" % (phase, counters["seconds"]) +
+                         "".join("%15d" % counters[c] for c in self.COUNTERS[1:]))
+        return "\n".join(lines)
+
+
+class InotifyWatcher(object):
+    """Watch a folder tree for changed files with the Linux inotify API, through ctypes"""
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, root):
+        super(InotifyWatcher, self).__init__()
+
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self.libc, "inotify_init"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.getErrno = ctypes.get_errno
+
+        self.root = root
+        self.watches = {}  # Maps the watch descriptor to the folder, relative to root
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(self.getErrno(), os.strerror(self.getErrno()))
+        self.addTree("")
+
+    def addTree(self, folder):
+        """Watch 'folder' and all its subfolders, returning the files they contain"""
+        files = []
+        for rootdir, dirs, names in os.walk(os.path.join(self.root, folder)):
+            relDir = os.path.relpath(rootdir, self.root).replace(os.sep, "/")
+            relDir = "" if relDir == "." else relDir
+            wd = self.libc.inotify_add_watch(self.fd, rootdir.encode(sys.getfilesystemencoding()), self.MASK)
+            if wd < 0:
+                raise OSError(self.getErrno(), os.strerror(self.getErrno()), rootdir)
+            self.watches[wd] = relDir
+            files.extend((relDir + "/" + name).lstrip("/") for name in names)
+        return files
+
+    def poll(self, timeout=None):
+        """Wait up to 'timeout' seconds (forever if None) for changes, returning the set of changed paths
+        relative to the root, or None if the kernel dropped some events"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        data = os.read(self.fd, 65536)
+        changes = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0").decode(sys.getfilesystemencoding())
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if wd not in self.watches:
+                continue
+            path = (self.watches[wd] + "/" + name).strip("/")
+            changes.add(path)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                # Files may be written in a new folder before it is watched
+                changes.update(self.addTree(path))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Watch a folder tree for changed files by comparing the size and modification time of all its files"""
+
+    def __init__(self, root, interval=1.0):
+        super(PollingWatcher, self).__init__()
+
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for rootdir, dirs, files in os.walk(self.root):
+            for f in files:
+                path = os.path.join(rootdir, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # Deleted while scanning
+                snapshot[os.path.relpath(path, self.root).replace(os.sep, "/")] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def poll(self, timeout=None):
+        """Wait up to 'timeout' seconds (forever if None) for changes, returning the set of changed paths
+        relative to the root"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.time())))
+            snapshot = self.scan()
+            changes = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changes or (deadline is not None and time.time() >= deadline):
+                return changes
+
+    def close(self):
+        pass
+
+
+class ImportManifest(object):
+    """Keeps track of the files copied inside the Eclipse project by a previous import"""
+
+    FILENAME = ".cubemximporter.manifest"
+
+    def __init__(self, eclipseprojectpath, sources=None):
+        super(ImportManifest, self).__init__()
+
+        self.sources = sources or SourceFiles()
+        self.path = os.path.join(eclipseprojectpath, self.FILENAME)
+        self.previous = {}
+        self.current = {}
+        self.digests = {}  # Maps the (path, size, mtime) of a source file to its SHA1 digest
+        self.loaded = False
+
+    def load(self):
+        """Load the manifest written by the last import, if any"""
+        try:
+            with open(self.path) as f:
+                self.previous = json.load(f).get("files", {})
+            self.loaded = True
+        except (IOError, OSError, ValueError):
+            self.previous = {}
+            self.loaded = False
+
+    def save(self):
+        """Store the files recorded during this import inside the Eclipse project"""
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"version": version, "files": self.current}, f, indent=1, sort_keys=True)
+        replaceFile(tmpPath, self.path)
+        self.loaded = True
+
+    def restart(self, phases=None):
+        """Start a new import of the same project, after the previous one was saved. If only some
+        'phases' run again, the files recorded by the other phases are kept"""
+        self.previous = self.current
+        self.current = dict((key, entry) for key, entry in self.previous.items()
+                            if phases is not None and entry.get("phase") not in phases)
+        self.digests = {}
+
+    def hashFile(self, src, srcStat):
+        """The SHA1 digest of 'src', computed once per import even if checked when planning and applying"""
+        key = (src, srcStat.st_size, srcStat.st_mtime)
+        digest = self.digests.get(key)
+        if digest is None:
+            digest = self.digests[key] = self.sources.hashFile(src)
+        return digest
+
+    def isUpToDate(self, key, src, dst, phase=None, mode="copy", record=True):
+        """Check if 'dst' already holds the content of 'src' as recorded by the previous import,
+        materialized with the same link 'mode'. If 'record' is True, the file is recorded for this import"""
+        entry = self.previous.get(key)
+        if entry is None or entry.get("mode") != mode or not os.path.isfile(dst):
+            return False
+
+        srcStat = self.sources.stat(src)
+        if os.path.getsize(dst) != entry["size"] or srcStat.st_size != entry["size"]:
+            return False
+
+        if srcStat.st_mtime == entry["mtime"]:
+            # Same size and same modification time: trust the previous import
+            if record:
+                self.current[key] = dict(entry, phase=phase)
+            return True
+
+        # The file was touched (e.g. CubeMX regenerated it): compare the content
+        digest = self.hashFile(src, srcStat)
+        if digest != entry["sha1"]:
+            return False
+
+        if record:
+            self.record(key, src, digest, phase, mode)
+        return True
+
+    def record(self, key, src, digest=None, phase=None, mode="copy"):
+        """Record that 'src' was copied (or linked, according to 'mode') in the Eclipse project as 'key'
+        by the given import phase"""
+        srcStat = self.sources.stat(src)
+        self.current[key] = {"src": src,
+                             "size": srcStat.st_size,
+                             "mtime": srcStat.st_mtime,
+                             "sha1": digest or self.hashFile(src, srcStat),
+                             "phase": phase,
+                             "mode": mode}
+
+
+class ImportStamp(object):
+    """Fingerprint of the inputs of the last import: the files of the CubeMX project, the importer version
+    and options. It tells in a few milliseconds if the Eclipse project is up to date, without parsing
+    any project file"""
+
+    FILENAME = ".cubemximporter.stamp"
+
+    def __init__(self, eclipseprojectpath, cubemxprojectpath, options):
+        super(ImportStamp, self).__init__()
+
+        self.path = os.path.join(eclipseprojectpath, self.FILENAME)
+        self.eclipseprojectpath = eclipseprojectpath
+        self.cubemxprojectpath = cubemxprojectpath
+        self.options = options
+
+    @staticmethod
+    def importOptions(linkMode, store, halModules, pruneMiddlewares, buildFiles, unityBatches, firmware,
+                      minimalIncludes):
+        """The options changing the result of an import. 'store' is the root of the shared store, or None"""
+        return {"linkMode": linkMode, "store": store, "halModules": halModules, "pruneMiddlewares": pruneMiddlewares,
+                "buildFiles": buildFiles, "unityBatches": unityBatches, "firmware": firmware,
+                "minimalIncludes": minimalIncludes}
+
+    @staticmethod
+    def fingerprint(root):
+        """SHA1 of the path, size and modification time of all the files inside 'root', or of the 'root'
+        file itself (e.g. an archive)"""
+        digest = hashlib.sha1()
+        if os.path.isfile(root):
+            st = os.stat(root)
+            digest.update(("%s\0%d\0%r\n" % (os.path.basename(root), st.st_size, st.st_mtime)).encode("UTF-8"))
+        for rootdir, dirs, files in os.walk(root):
+            dirs.sort()
+            for f in sorted(files):
+                path = os.path.join(rootdir, f)
+                st = os.stat(path)
+                digest.update(("%s\0%d\0%r\n" % (os.path.relpath(path, root).replace(os.sep, "/"), st.st_size,
+                                                  st.st_mtime)).encode("UTF-8"))
+        return digest.hexdigest()
+
+    def compute(self):
+        projectFile = os.stat(os.path.join(self.eclipseprojectpath, ".cproject"))
+        stamp = {"version": version,
+                 "options": self.options,
+                 "cubemx": self.fingerprint(self.cubemxprojectpath),
+                 "cproject": [projectFile.st_size, projectFile.st_mtime]}
+        if self.options.get("firmware"):
+            stamp["firmware"] = self.fingerprint(self.options["firmware"])
+        return stamp
+
+    def isUpToDate(self):
+        """Check if the stamp written by the last import matches the current inputs"""
+        try:
+            with open(self.path) as f:
+                return json.load(f) == self.compute()
+        except (IOError, OSError, ValueError):
+            return False
+
+    def save(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.compute(), f, indent=1, sort_keys=True)
+        replaceFile(tmpPath, self.path)
+
+    def invalidate(self):
+        """Remove the stamp, before the Eclipse project is modified"""
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class SharedStore(object):
+    """Content addressed store of vendor files shared by all the Eclipse projects on the machine"""
+
+    def __init__(self, root=None):
+        super(SharedStore, self).__init__()
+
+        self.root = root if root is not None else self.defaultRoot()
+        self.lock = threading.Lock()
+        self.used = {}  # Maps a version to the set of object digests used by this import
+        self.inUse = None  # Lock file held from the first stored object until the import is referenced
+
+    def makeDirs(self):
+        """Create the folders of the store, if missing. They are created by the first write, so that
+        dry runs leave no trace"""
+        for d in ("objects", "versions", "refs"):
+            if not os.path.isdir(os.path.join(self.root, d)):
+                try:
+                    os.makedirs(os.path.join(self.root, d))
+                except OSError as e:  # Another import could have created it meanwhile
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def acquire(self, name, shared=False):
+        """Open and lock the 'name' lock file of the store, returning it. Windows has no shared locks,
+        so they are exclusive there"""
+        self.makeDirs()
+        f = open(os.path.join(self.root, name), "a+")
+        try:
+            import fcntl
+        except ImportError:  # Windows
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except (IOError, OSError):  # LK_LOCK gives up after 10 seconds
+                    pass
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        return f
+
+    @staticmethod
+    def unlock(f):
+        """Release a lock file returned by acquire()"""
+        try:
+            import fcntl
+        except ImportError:  # Windows
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    @contextlib.contextmanager
+    def exclusive(self, name="lock"):
+        """Hold the lock of the store, shared by all the processes updating its versions and refs"""
+        f = self.acquire(name)
+        try:
+            yield
+        finally:
+            self.unlock(f)
+
+    def release(self):
+        """Let the garbage collector run again, once the objects stored by this import are referenced
+        or the import failed"""
+        with self.lock:
+            inUse, self.inUse = self.inUse, None
+        if inUse is not None:
+            self.unlock(inUse)
+
+    @staticmethod
+    def defaultRoot():
+        cacheDir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cacheDir, "cubemximporter")
+
+    def objectPath(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def put(self, src, version, sources=None):
+        """Add 'src' file to the store, if not already there. Returns the path of the stored object and its digest.
+        'sources' is the SourceFiles reading 'src', if it can be inside an archive"""
+        sources = sources or SourceFiles()
+        with self.lock:
+            if self.inUse is None:
+                # Objects not referenced yet by any version must survive a concurrent garbage collection
+                self.inUse = self.acquire("in-use", shared=True)
+        digest = sources.hashFile(src)
+        path = self.objectPath(digest)
+
+        if not os.path.exists(path):
+            self.makeDirs()
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            tmpPath = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+            sources.copy(src, tmpPath)
+            # Objects are shared among projects: make them read-only, so that they are not modified by mistake
+            os.chmod(tmpPath, 0o444)
+            try:
+                os.rename(tmpPath, path)
+            except OSError:  # Stored meanwhile by another import (rename doesn't overwrite on Windows)
+                os.unlink(tmpPath)
+
+        with self.lock:
+            self.used.setdefault(version, set()).add(digest)
+        return path, digest
+
+    def addReference(self, projectPath, version):
+        """Record that 'projectPath' uses the objects of 'version' stored during this import. The version
+        file is merged under the lock of the store, so that concurrent imports don't lose their objects"""
+        projectPath = os.path.abspath(projectPath)
+        versionFile = os.path.join(self.root, "versions", version + ".json")
+        refFile = os.path.join(self.root, "refs", hashlib.sha1(projectPath.encode("UTF-8")).hexdigest() + ".json")
+        with self.exclusive():
+            digests = set(self.used.get(version, ()))
+            try:
+                with open(versionFile) as f:
+                    digests.update(json.load(f))
+            except (IOError, OSError, ValueError):
+                pass
+            self.__writeJSON(versionFile, sorted(digests))
+            self.__writeJSON(refFile, {"project": projectPath, "version": version})
+        self.release()
+
+    def __writeJSON(self, path, content):
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpPath, "w") as f:
+            json.dump(content, f)
+        replaceFile(tmpPath, path)
+
+    def collectGarbage(self):
+        """Remove the versions no longer used by any existing Eclipse project, and the objects they
+        were the only ones to use. Returns the number of versions and objects removed"""
+        with self.exclusive("in-use"):  # Waits for the imports storing objects not referenced yet
+            with self.exclusive():
+                return self.__collectGarbage()
+
+    def __collectGarbage(self):
+        live = set()
+        refsDir = os.path.join(self.root, "refs")
+        for ref in os.listdir(refsDir):
+            try:
+                with open(os.path.join(refsDir, ref)) as f:
+                    reference = json.load(f)
+            except (IOError, OSError, ValueError):
+                reference = None
+            if reference and os.path.exists(os.path.join(reference["project"], ".cproject")):
+                live.add(reference["version"])
+            else:
+                os.remove(os.path.join(refsDir, ref))
+
+        liveObjects = set()
+        removedVersions = 0
+        versionsDir = os.path.join(self.root, "versions")
+        for versionFile in os.listdir(versionsDir):
+            path = os.path.join(versionsDir, versionFile)
+            if versionFile[:-len(".json")] in live:
+                with open(path) as f:
+                    liveObjects.update(json.load(f))
+            else:
+                os.remove(path)
+                removedVersions += 1
+
+        removedObjects = 0
+        objectsDir = os.path.join(self.root, "objects")
+        for prefix in os.listdir(objectsDir):
+            for name in os.listdir(os.path.join(objectsDir, prefix)):
+                if prefix + name not in liveObjects:
+                    os.remove(os.path.join(objectsDir, prefix, name))
+                    removedObjects += 1
+
+        return removedVersions, removedObjects
+
+
+class SourceArchive(object):
+    """Index of the files and folders inside a zip or tar archive, read without extracting it.
+    Every thread reads the archive through its own handle, so that files can be copied in parallel"""
+
+    EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+    def __init__(self, path):
+        super(SourceArchive, self).__init__()
+
+        import zipfile
+        self.path = path
+        self.isZip = zipfile.is_zipfile(path)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.handles = []
+        self.entries = {}  # Maps the path of every file to its (member, size, mtime, mode, position) tuple
+        self.folders = {"": set()}  # Maps the path of every folder to the names of its entries
+
+        if self.isZip:
+            for info in self.handle().infolist():
+                mode = (info.external_attr >> 16) & 0o777 if info.create_system == 3 else 0
+                self.add(info.filename, info.filename.endswith("/"), info, info.file_size,
+                         time.mktime(info.date_time + (0, 0, -1)), mode, info.header_offset)
+        else:
+            for member in self.handle().getmembers():
+                if member.isfile() or member.isdir():
+                    self.add(member.name, member.isdir(), member, member.size, member.mtime, member.mode,
+                             member.offset)
+
+    def add(self, name, isDir, member, size, mtime, mode, position):
+        name = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+        if name in (".", "") or name.startswith("../"):
+            return
+        parts = name.split("/")
+        for i in range(len(parts)):
+            self.folders.setdefault("/".join(parts[:i]), set()).add(parts[i])
+        if isDir:
+            self.folders.setdefault(name, set())
+        else:
+            self.entries[name] = (member, size, mtime, mode, position)
+
+    def handle(self):
+        """The archive opened by the calling thread"""
+        handle = getattr(self.local, "handle", None)
+        if handle is None:
+            if self.isZip:
+                import zipfile
+                handle = zipfile.ZipFile(self.path)
+            else:
+                import tarfile
+                handle = tarfile.open(self.path)
+            self.local.handle = handle
+            with self.lock:
+                self.handles.append(handle)
+        return handle
+
+    def open(self, name):
+        member = self.entries[name][0]
+        if self.isZip:
+            return self.handle().open(member)
+        return contextlib.closing(self.handle().extractfile(member))
+
+    def close(self):
+        with self.lock:
+            for handle in self.handles:
+                handle.close()
+            self.handles = []
+            self.local = threading.local()
+
+
+class SourceStat(object):
+    """Size and modification time of a file inside an archive, as the fields of os.stat()"""
+
+    def __init__(self, size, mtime):
+        super(SourceStat, self).__init__()
+
+        self.st_size = size
+        self.st_mtime = mtime
+
+
+class SourceFiles(object):
+    """Read-only access to project and firmware files, either in a folder or inside a mounted archive"""
+
+    def __init__(self):
+        super(SourceFiles, self).__init__()
+
+        self.archives = {}  # Maps the path of every mounted archive to its SourceArchive
+
+    @staticmethod
+    def isArchive(path):
+        return os.path.isfile(path) and path.lower().endswith(SourceArchive.EXTENSIONS)
+
+    def mount(self, path):
+        """Mount a zip or tar archive, returning the path of its root folder: the only top level folder of
+        the archive, if it contains nothing else (e.g. STM32Cube_FW_F4_V1.16.0/), or the archive itself"""
+        path = path.rstrip("/" + os.sep)
+        if path in self.archives:
+            self.archives[path].close()
+        archive = self.archives[path] = SourceArchive(path)
+        names = archive.folders[""]
+        if len(names) == 1 and next(iter(names)) in archive.folders:
+            return os.path.join(path, next(iter(names)))
+        return path
+
+    def locate(self, path):
+        """Split a path in the mounted archive containing it and the path of the entry inside the archive.
+        The archive is None if the path is not inside a mounted archive"""
+        for archivePath, archive in self.archives.items():
+            if path == archivePath:
+                return archive, ""
+            if path.startswith(archivePath) and path[len(archivePath)] in ("/", os.sep):
+                name = posixpath.normpath(path[len(archivePath) + 1:].replace(os.sep, "/"))
+                return archive, "" if name == "." else name
+        return None, path
+
+    def isArchived(self, path):
+        return self.locate(path)[0] is not None
+
+    def exists(self, path):
+        archive, name = self.locate(path)
+        if archive is None:
+            return os.path.exists(path)
+        return name in archive.entries or name in archive.folders
+
+    def isfile(self, path):
+        archive, name = self.locate(path)
+        return os.path.isfile(path) if archive is None else name in archive.entries
+
+    def isdir(self, path):
+        archive, name = self.locate(path)
+        return os.path.isdir(path) if archive is None else name in archive.folders
+
+    def listdir(self, path):
+        archive, name = self.locate(path)
+        if archive is None:
+            return os.listdir(path)
+        if name not in archive.folders:
+            raise OSError(errno.ENOENT, "No such file or directory", path)
+        return sorted(archive.folders[name])
+
+    def walk(self, top):
+        """Walk a folder tree top-down, like os.walk()"""
+        archive, name = self.locate(top)
+        if archive is None:
+            for entry in os.walk(top):
+                yield entry
+            return
+        if name not in archive.folders:
+            return
+
+        prefix = name + "/" if name else ""
+        entries = sorted(archive.folders[name])
+        dirs = [e for e in entries if prefix + e in archive.folders]
+        files = [e for e in entries if prefix + e in archive.entries]
+        yield top, dirs, files
+        for d in dirs:
+            for entry in self.walk(os.path.join(top, d)):
+                yield entry
+
+    def stat(self, path):
+        archive, name = self.locate(path)
+        if archive is None:
+            return os.stat(path)
+        if name not in archive.entries:
+            raise OSError(errno.ENOENT, "No such file or directory", path)
+        member, size, mtime, mode, position = archive.entries[name]
+        return SourceStat(size, mtime)
+
+    def getsize(self, path):
+        return self.stat(path).st_size
+
+    def position(self, path):
+        """Sort key placing the files of an archive in the order they are stored, so that compressed
+        tar archives are read sequentially"""
+        archive, name = self.locate(path)
+        if archive is None or name not in archive.entries:
+            return ("", 0)
+        return (archive.path, archive.entries[name][4])
+
+    def open(self, path):
+        """Open a file for reading in binary mode"""
+        archive, name = self.locate(path)
+        if archive is None:
+            return open(path, "rb")
+        if name not in archive.entries:
+            raise IOError(errno.ENOENT, "No such file or directory", path)
+        return archive.open(name)
+
+    def read(self, path):
+        with self.open(path) as f:
+            return f.read()
+
+    def readText(self, path):
+        return self.read(path).decode("UTF-8", "replace")
+
+    def hashFile(self, path):
+        """Compute the SHA1 digest of a file"""
+        digest = hashlib.sha1()
+        with self.open(path) as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def copy(self, src, dst, metadata=False):
+        """Stream the content of 'src' to 'dst', preserving its permission bits and modification time
+        if 'metadata' is True. Returns the number of bytes copied"""
+        archive, name = self.locate(src)
+        if archive is None:
+            if metadata:
+                shutil.copy2(src, dst)
+            else:
+                shutil.copyfile(src, dst)
+            return os.path.getsize(dst)
+
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        with archive.open(name) as fsrc:
+            with open(dst, "wb") as fdst:
+                shutil.copyfileobj(fsrc, fdst, 65536)
+        member, size, mtime, mode, position = archive.entries[name]
+        if metadata:
+            if mode:
+                os.chmod(dst, mode)
+            os.utime(dst, (mtime, mtime))
+        return size
+
+    def sameContent(self, src, dst):
+        """Check if 'dst' has the same content of 'src'"""
+        if not self.isArchived(src):
+            return filecmp.cmp(src, dst)
+        if self.getsize(src) != os.path.getsize(dst):
+            return False
+        with self.open(src) as fsrc:
+            with open(dst, "rb") as fdst:
+                for chunk in iter(lambda: fsrc.read(65536), b""):
+                    if fdst.read(len(chunk)) != chunk:
+                        return False
+        return True
+
+    def close(self):
+        """Release the handles of the mounted archives"""
+        for archive in self.archives.values():
+            archive.close()
+
+
+class ProjectIndex(object):
+    """Collects the layout of a CubeMX project with a single walk of its folder tree"""
+
+    # Middleware libraries the importer cares about
+    MIDDLEWARES = ("FreeRTOS", "FatFs", "LwIP")
+
+    def __init__(self, cubemxprojectpath, sw4stm32projectpath, sources=None):
+        super(ProjectIndex, self).__init__()
+
+        self.sources = sources or SourceFiles()
+        self.cubemxprojectpath = cubemxprojectpath
+        self.sw4stm32projectpath = sw4stm32projectpath
+        self.cprojectPath = None
+        self.iocPath = None
+        self.topLevelDirs = set()
+        self.middlewares = set()
+        self.systemFile = None
+        self.startupFile = None
+        self.layoutVersion = None
+
+        self.scan()
+
+    def scan(self):
+        """Walk the CubeMX project once, pruning the folders that are not relevant to the import"""
+        swRelPath = os.path.relpath(self.sw4stm32projectpath, self.cubemxprojectpath)
+
+        for rootdir, dirs, files in self.sources.walk(self.cubemxprojectpath):
+            relPath = os.path.relpath(rootdir, self.cubemxprojectpath)
+            parts = [] if relPath == os.curdir else relPath.split(os.sep)
+
+            if self.cprojectPath is None and ".cproject" in files and \
+                    (swRelPath == os.curdir or parts[:1] == [swRelPath]):
+                self.cprojectPath = os.path.join(rootdir, ".cproject")
+
+            if not parts:
+                self.topLevelDirs = set(dirs)
+                iocFiles = sorted(f for f in files if f.endswith(".ioc"))
+                self.iocPath = os.path.join(rootdir, iocFiles[0]) if iocFiles else None
+                # Drivers/ has a well known layout, so it is never walked. SW4STM32/ is walked only
+                # to find the .cproject file of CubeMX < 4.14
+                dirs[:] = [d for d in dirs if d == "Middlewares" or
+                           (d == swRelPath and self.cprojectPath is None)]
+            elif parts[0] == "Middlewares":
+                self.middlewares.update(d for d in dirs if d in self.MIDDLEWARES)
+                if len(parts) >= 2:  # Middlewares/<vendor>/<library> is deep enough
+                    dirs[:] = []
+            elif self.cprojectPath is not None:
+                dirs[:] = []
+
+    def firmwareVersion(self):
+        """Retrieve the version of the STM32Cube firmware package (e.g. V1.16.0) used to generate the project"""
+        if self.iocPath is not None:
+            for line in self.sources.readText(self.iocPath).splitlines():
+                match = re.match(r"ProjectManager\.FirmwarePackage=.*\s(V[0-9][0-9.]*)", line)
+                if match:
+                    return match.group(1)
+        return "unknown"
+
+    def hasMiddlewares(self):
+        return "Middlewares" in self.topLevelDirs
+
+    def hasMiddleware(self, name):
+        return name in self.middlewares
+
+    def locateDeviceFiles(self, halType, mcuType, firmwareDriversDir=None):
+        """Find the system and startup files of the MCU, and deduce the CubeMX release that generated the project.
+        Device files missing in the project are taken from the Drivers folder of the firmware package, if given.
+        In that case the layout is deduced only from the device files found in the project"""
+        templatesDir = os.path.join(self.cubemxprojectpath,
+                                    "Drivers/CMSIS/Device/ST/STM32%sxx/Source/Templates" % halType)
+        # Projects generated with the libraries added as reference don't have the device files
+        firmwareTemplatesDir = os.path.join(firmwareDriversDir, "CMSIS/Device/ST/STM32%sxx/Source/Templates" %
+                                            halType) if firmwareDriversDir is not None else None
+
+        self.layoutVersion = 414 if self.sw4stm32projectpath == self.cubemxprojectpath else 413
+
+        self.systemFile = os.path.join(templatesDir, "system_stm32%sxx.c" % halType.lower())
+        if not self.sources.exists(self.systemFile):
+            #CubeMX 4.18 moved the system_stm32XXxx.c file inside the main src folder
+            srcFile = os.path.join(self.cubemxprojectpath, "Src/system_stm32%sxx.c" % halType.lower())
+            if self.sources.exists(srcFile) or firmwareTemplatesDir is None:
+                self.layoutVersion = 418
+                self.systemFile = srcFile
+            else:
+                self.systemFile = os.path.join(firmwareTemplatesDir, "system_stm32%sxx.c" % halType.lower())
+
+        self.startupFile = os.path.join(templatesDir, "gcc/startup_%s.s" % mcuType.lower())
+        if not self.sources.exists(self.startupFile):
+            #CubeMX 4.19 moved the system_stm32XXxx.s file inside the startup folder
+            startupFile = os.path.join(self.cubemxprojectpath, "startup/startup_%s.s" % mcuType.lower())
+            if self.sources.exists(startupFile) or firmwareTemplatesDir is None:
+                self.layoutVersion = 419
+                self.startupFile = startupFile
+            else:
+                self.startupFile = os.path.join(firmwareTemplatesDir, "gcc/startup_%s.s" % mcuType.lower())
+
+
+class SW4STM32Configuration(object):
+    """Settings of a build configuration (e.g. Debug, Release) of a SW4STM32 project"""
+
+    def __init__(self, name, defines, includes):
+        super(SW4STM32Configuration, self).__init__()
+
+        self.name = name
+        self.defines = defines
+        self.includes = includes
+
+    @property
+    def mcuType(self):
+        """The MCU define (e.g. STM32F401xE), or None if the configuration doesn't declare it"""
+        mcuType = None
+        for define in self.defines:
+            if "STM32" in define:
+                mcuType = define
+        return mcuType
+
+    @property
+    def halType(self):
+        """The HAL family (e.g. F4) of the MCU, or None if unknown"""
+        match = re.search("([FL][0-9])", self.mcuType or "")
+        return match.group(1) if match else None
+
+
+class SW4STM32Project(object):
+    """Model of the .cproject file generated by CubeMX for the SW4STM32 tool-chain.
+
+    The file is parsed once, and parsed again only if it is modified. It can be used
+    to query the MCU and HAL of a CubeMX project without importing it:
+
+        project = SW4STM32Project("path/to/cubemx/project/.cproject")
+        print(project.mcuType, project.halType, project.configuration("Debug").includes)
+    """
+
+    DEFINES_OPTION = "gnu.c.compiler.option.preprocessor.def.symbols"
+    INCLUDES_OPTION = "gnu.c.compiler.option.include.paths"
+
+    def __init__(self, path, sources=None):
+        super(SW4STM32Project, self).__init__()
+
+        self.sources = sources or SourceFiles()
+        self.path = path
+        self.mtime = None
+        self.isAC6 = False
+        self.configurations = []
+        self.refresh()
+
+    def refresh(self):
+        """Parse the .cproject file again if it was modified since the last time it was read"""
+        mtime = self.sources.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return False
+
+        content = self.sources.read(self.path)
+        self.isAC6 = content.find(b"ac6") >= 0
+        root = etree.fromstring(content)
+
+        self.configurations = []
+        for configuration in root.iter("configuration"):
+            self.configurations.append(self.__parseConfiguration(configuration.attrib.get("name", ""), configuration))
+        if not self.configurations:
+            self.configurations.append(self.__parseConfiguration("", root))
+
+        self.mtime = mtime
+        return True
+
+    def __parseConfiguration(self, name, node):
+        def optionValues(superClass):
+            options = node.xpath(".//option[@superClass='%s']" % superClass)
+            return [opt.attrib["value"] for opt in options[0]] if options else []
+
+        return SW4STM32Configuration(name, optionValues(self.DEFINES_OPTION), optionValues(self.INCLUDES_OPTION))
+
+    def configuration(self, name=None):
+        """Retrieve a build configuration by name. The first one (usually Debug) is returned if name is None"""
+        for configuration in self.configurations:
+            if name is None or configuration.name == name:
+                return configuration
+        raise KeyError("No '%s' build configuration in '%s'" % (name, self.path))
+
+    @property
+    def mcuType(self):
+        return self.configuration().mcuType
+
+    @property
+    def halType(self):
+        return self.configuration().halType
+
+    @property
+    def includes(self):
+        return self.configuration().includes
+
+
+class EclipseProjectEdits(object):
+    """A batch of include paths, macros and source entries to add to the Eclipse project settings"""
+
+    OPTION_PREFIX = "ilg.gnuarmeclipse.managedbuild.cross.option."
+    TOOLS = ("assembler", "c.compiler", "cpp.compiler")
+
+    def __init__(self):
+        super(EclipseProjectEdits, self).__init__()
+
+        self.optionValues = []  # List of (superClass, values, quote) tuples, in the order they are applied
+        self.optionLists = []  # List of (superClass, values, configuration) tuples replacing the option values
+        self.sourceEntries = []
+        self.buildExclusions = []  # List of (project relative path, excluded) tuples
+
+    def addIncludes(self, includes, tools=TOOLS):
+        """Add a list of include paths to the given tools (by default assembler, C and C++)"""
+        for tool in tools:
+            self.optionValues.append((self.OPTION_PREFIX + tool + ".include.paths", list(includes), True))
+        return self
+
+    def setIncludes(self, includes, tools=TOOLS, configuration=None):
+        """Replace the include paths of the given tools, in all configurations or only in the named one.
+        Include paths are given as stored in the project, i.e. quoted"""
+        for tool in tools:
+            self.optionLists.append((self.OPTION_PREFIX + tool + ".include.paths", list(includes), configuration))
+        return self
+
+    def addMacros(self, macros, tools=TOOLS):
+        """Add a list of macros to the given tools (by default assembler, C and C++)"""
+        for tool in tools:
+            self.optionValues.append((self.OPTION_PREFIX + tool + ".defs", list(macros), False))
+        return self
+
+    def addSourceEntries(self, entries):
+        """Add a list of directory to the source entries list"""
+        self.sourceEntries.extend(entries)
+        return self
+
+    def excludeFromBuild(self, paths):
+        """Exclude a list of project files from the build"""
+        self.buildExclusions.extend((path, True) for path in paths)
+        return self
+
+    def includeInBuild(self, paths):
+        """Remove a list of project files from the build exclusions, if previously excluded"""
+        self.buildExclusions.extend((path, False) for path in paths)
+        return self
+
+
+class EclipseProjectOptions(object):
+    """Index of the options and source entries of every build configuration of an Eclipse project,
+    built with a single pass over the DOM"""
+
+    def __init__(self, root):
+        super(EclipseProjectOptions, self).__init__()
+
+        self.options = {}  # Maps the superClass to a list of (option node, set of values) for each configuration
+        self.sourceEntries = []  # List of (sourceEntries node, set of entry names) for each configuration
+        self.queries = 0  # Lookups of options and source entries, each one replacing a XPath evaluation
+        self.nodesAdded = 0
+
+        for node in root.iter("option", "sourceEntries"):
+            if node.tag == "option":
+                values = set(o.attrib.get("value") for o in node)
+                self.options.setdefault(node.attrib.get("superClass"), []).append((node, values))
+            else:
+                self.sourceEntries.append((node, set(e.attrib.get("name") for e in node)))
+
+    def addOptionValues(self, superClass, values, quote=True):
+        """Add a list of values to the option with the given superClass in all configurations"""
+        # The way how include paths and macros are stored differs. Include paths are quoted with ""
+        pattern = '"%s"' if quote else '%s'
+        self.queries += 1
+        for opt, optionsValues in self.options.get(superClass, ()):
+            for v in values:
+                if pattern % v in optionsValues:  # Avoid to place the same value again
+                    continue
+                if len(opt):
+                    listOptionValue = copy.deepcopy(opt[0])
+                else:
+                    listOptionValue = etree.SubElement(opt, "listOptionValue", builtIn="false")
+                # Quotes are escaped as &quot; when the project is saved, as Eclipse expects
+                listOptionValue.attrib["value"] = pattern % v
+                opt.append(listOptionValue)
+                optionsValues.add(pattern % v)
+                self.nodesAdded += 1
+
+    def setOptionValues(self, superClass, values, configuration=None):
+        """Replace the values of the option with the given superClass, in all configurations or only in the
+        one with the given name. Values are stored as given, and the nodes of the existing ones are kept"""
+        self.queries += 1
+        for opt, optionsValues in self.options.get(superClass, ()):
+            if configuration is not None and not any(node.tag == "configuration" and
+                                                     node.attrib.get("name") == configuration
+                                                     for node in opt.iterancestors()):
+                continue
+            if [o.attrib.get("value") for o in opt] == list(values):
+                continue
+            nodes = dict((o.attrib.get("value"), o) for o in opt)
+            template = opt[0] if len(opt) else None
+            for o in list(opt):
+                opt.remove(o)
+            for v in values:
+                listOptionValue = nodes.get(v)
+                if listOptionValue is None:
+                    if template is not None:
+                        listOptionValue = copy.deepcopy(template)
+                    else:
+                        listOptionValue = etree.Element("listOptionValue", builtIn="false")
+                    listOptionValue.attrib["value"] = v
+                    self.nodesAdded += 1
+                if listOptionValue.tail is None:  # Laid out one per line, as the values of an emptied option
+                    listOptionValue.tail = opt.text
+                opt.append(listOptionValue)
+            optionsValues.clear()
+            optionsValues.update(values)
+
+    def addSourceEntries(self, entries):
+        """Add a list of directory to the source entries list of all configurations"""
+        self.queries += 1
+        for source, names in self.sourceEntries:
+            for e in entries:
+                if e in names:  # Avoid to add the same entry again when re-importing
+                    continue
+                logging.debug("Adding '%s' folder to source entries" % e)
+                entry = copy.deepcopy(source[0])
+                entry.attrib["name"] = e
+                entry.attrib.pop("excluding", None)
+                source.append(entry)
+                names.add(e)
+                self.nodesAdded += 1
+
+    def setExcludedFromBuild(self, path, excluded=True):
+        """Exclude (or include again) a project file from the build of all configurations"""
+        self.queries += 1
+        for source, names in self.sourceEntries:
+            # The exclusion is stored in the 'excluding' attribute of the source entry containing the file,
+            # relative to the entry folder
+            entries = [e for e in source if e.attrib.get("name", "") == "" or
+                       path.startswith(e.attrib["name"].rstrip("/") + "/")]
+            if not entries:
+                continue
+            entry = max(entries, key=lambda e: len(e.attrib.get("name", "")))
+            name = entry.attrib.get("name", "")
+            relPath = path[len(name.rstrip("/")) + 1:] if name else path
+
+            excluding = [e for e in entry.attrib.get("excluding", "").split("|") if e]
+            if excluded and relPath not in excluding:
+                excluding.append(relPath)
+            elif not excluded and relPath in excluding:
+                excluding.remove(relPath)
+            else:
+                continue
+
+            if excluding:
+                entry.attrib["excluding"] = "|".join(excluding)
+            else:
+                del entry.attrib["excluding"]
+
+    def excludedFromBuild(self, folder):
+        """The project files inside 'folder' excluded from the build of any configuration"""
+        self.queries += 1
+        paths = set()
+        for source, names in self.sourceEntries:
+            for entry in source:
+                name = entry.attrib.get("name", "").rstrip("/")
+                for relPath in entry.attrib.get("excluding", "").split("|"):
+                    path = name + "/" + relPath if name else relPath
+                    if relPath and path.startswith(folder.rstrip("/") + "/"):
+                        paths.add(path)
+        return sorted(paths)
+
+
+class BuildDescription(object):
+    """The sources, flags, include paths and macros of a build configuration of the Eclipse project,
+    used to generate command line builds with the arm-none-eabi toolchain"""
+
+    OUTPUTS = ("build.ninja", "CMakeLists.txt", "compile_commands.json")
+    BUILD_DIR = "build"
+
+    # Tool of the GNU ARM Eclipse plugin compiling each kind of source file
+    TOOLS = {".c": "c.compiler", ".cpp": "cpp.compiler", ".cc": "cpp.compiler", ".cxx": "cpp.compiler",
+             ".s": "assembler", ".S": "assembler", ".asm": "assembler"}
+    FPU_UNITS = {"fpv4spd16": "fpv4-sp-d16", "fpv5spd16": "fpv5-sp-d16", "fpv5d16": "fpv5-d16",
+                 "vfpv3d16": "vfpv3-d16", "neonvfpv4": "neon-vfpv4"}
+    OPTIMIZATION_LEVELS = {"none": "-O0", "optimize": "-O1", "more": "-O2", "most": "-O3", "size": "-Os",
+                           "fast": "-Ofast", "debug": "-Og"}
+    DEBUGGING_LEVELS = {"minimal": "-g1", "default": "-g", "max": "-g3"}
+
+    # Boolean options of the toolchain, applied to every tool, with their flag and the value of the
+    # project templates of the GNU ARM Eclipse plugin, used when the option is not set
+    TOOLCHAIN_FLAGS = (("optimization.messagelength", "-fmessage-length=0", False),
+                       ("optimization.signedchar", "-fsigned-char", False),
+                       ("optimization.functionsections", "-ffunction-sections", True),
+                       ("optimization.datasections", "-fdata-sections", True),
+                       ("optimization.nocommon", "-fno-common", False),
+                       ("optimization.noinlinefunctions", "-fno-inline-functions", False),
+                       ("optimization.freestanding", "-ffreestanding", False),
+                       ("optimization.nobuiltin", "-fno-builtin", False),
+                       ("optimization.spconstant", "-fsingle-precision-constant", False),
+                       ("optimization.PIC", "-fPIC", False),
+                       ("optimization.lto", "-flto", False),
+                       ("optimization.nomoveloopinvariants", "-fno-move-loop-invariants", False),
+                       ("warnings.allwarn", "-Wall", True),
+                       ("warnings.extrawarn", "-Wextra", False),
+                       ("warnings.pedantic", "-pedantic", False),
+                       ("warnings.pedanticerrors", "-pedantic-errors", False),
+                       ("warnings.conversion", "-Wconversion", False),
+                       ("warnings.unitialized", "-Wuninitialized", False),
+                       ("warnings.missingdeclaration", "-Wmissing-declarations", False),
+                       ("warnings.pointerarith", "-Wpointer-arith", False),
+                       ("warnings.shadow", "-Wshadow", False),
+                       ("warnings.logicalop", "-Wlogical-op", False),
+                       ("warnings.agreggatereturn", "-Waggregate-return", False),
+                       ("warnings.floatequal", "-Wfloat-equal", False),
+                       ("warnings.toerrors", "-Werror", False),
+                       ("warnings.nowarn", "-w", False))
+    CPP_FLAGS = (("cpp.compiler.noexceptions", "-fno-exceptions", True),
+                 ("cpp.compiler.nortti", "-fno-rtti", True),
+                 ("cpp.compiler.nousecxaatexit", "-fno-use-cxa-atexit", False),
+                 ("cpp.compiler.nothreadsafestatics", "-fno-threadsafe-statics", False))
+    LINKER_FLAGS = (("linker.nostart", "-nostartfiles", True),
+                    ("linker.nodeflibs", "-nodefaultlibs", False),
+                    ("linker.nostdlibs", "-nostdlib", False),
+                    ("linker.gcsections", "-Xlinker --gc-sections", True),
+                    ("linker.usenewlibnano", "--specs=nano.specs", True),
+                    ("linker.usenewlibnosys", "--specs=nosys.specs", False),
+                    ("linker.useprintffloat", "-u _printf_float", False),
+                    ("linker.usescanffloat", "-u _scanf_float", False))
+
+    def __init__(self, projectRoot, eclipseprojectpath, halType=None, configuration=None):
+        super(BuildDescription, self).__init__()
+
+        self.path = os.path.abspath(eclipseprojectpath)
+        self.name = self.projectName()
+        configurations = [c for c in projectRoot.iter("configuration")
+                          if configuration is None or c.attrib.get("name") == configuration]
+        if not configurations:
+            raise KeyError("No '%s' build configuration in the Eclipse project" % configuration)
+        self.configuration = configurations[0]
+        self.configurationName = self.configuration.attrib.get("name", "")
+
+        self.includes = {}
+        self.macros = {}
+        for tool in EclipseProjectEdits.TOOLS:
+            self.includes[tool] = [self.projectPath(v) for v in self.optionValues(tool + ".include.paths")]
+            self.macros[tool] = self.optionValues(tool + ".defs")
+        self.cpuFlags = self.targetFlags(halType)
+        self.sources = self.findSources()
+
+    def projectName(self):
+        """The name of the Eclipse project, from the .project file or the project folder"""
+        projectFile = os.path.join(self.path, ".project")
+        if os.path.exists(projectFile):
+            match = re.search(r"<name>([^<]+)</name>", open(projectFile).read())
+            if match:
+                return match.group(1).strip()
+        return os.path.basename(self.path.rstrip(os.sep))
+
+    def option(self, name):
+        for option in self.configuration.iter("option"):
+            if option.attrib.get("superClass") == EclipseProjectEdits.OPTION_PREFIX + name:
+                return option
+        return None
+
+    def optionValues(self, name):
+        option = self.option(name)
+        return [o.attrib["value"].strip('"') for o in option] if option is not None else []
+
+    def optionValue(self, name):
+        """The value of a single value option, or None if not set"""
+        option = self.option(name)
+        return option.attrib.get("value") if option is not None else None
+
+    def booleanFlags(self, options, prefix=""):
+        """The flags of the enabled boolean (option name, flag, default value) options"""
+        flags = []
+        for name, flag, default in options:
+            value = self.optionValue(prefix + name)
+            if (value == "true") if value is not None else default:
+                flags += flag.split()
+        return flags
+
+    def otherFlags(self, name):
+        """The flags of a free text option, such as 'Other compiler flags'"""
+        import shlex
+        return shlex.split(self.optionValue(name) or "")
+
+    def projectPath(self, path):
+        """Make a path of the Eclipse project settings (relative to the build folder) relative to the project"""
+        for prefix in ("${ProjDirPath}/", "${workspace_loc:/${ProjName}/", "../"):
+            if path.startswith(prefix):
+                return path[len(prefix):].rstrip("}") or "."
+        return path
+
+    def targetFlags(self, halType):
+        """The -mcpu, -mthumb and FPU flags of the configuration, or the ones of the HAL family if not set"""
+        flags = []
+        family = self.option("arm.target.family")
+        cpu = family.attrib.get("value", "").split(".")[-1] if family is not None else HAL_CPUS.get(halType)
+        if cpu:
+            flags.append("-mcpu=%s" % cpu)
+        instructionSet = self.option("arm.target.instructionset")
+        if instructionSet is None or instructionSet.attrib.get("value", "").endswith(".thumb"):
+            flags.append("-mthumb")
+        abi = self.option("arm.target.fpu.abi")
+        if abi is not None and abi.attrib.get("value", "").split(".")[-1] in ("soft", "softfp", "hard"):
+            flags.append("-mfloat-abi=%s" % abi.attrib["value"].split(".")[-1])
+        unit = self.option("arm.target.fpu.unit")
+        if unit is not None and unit.attrib.get("value", "").split(".")[-1] in self.FPU_UNITS:
+            flags.append("-mfpu=%s" % self.FPU_UNITS[unit.attrib["value"].split(".")[-1]])
+        return flags
+
+    def findSources(self):
+        """List the project relative paths of the sources inside the source entries, except the excluded ones"""
+        sources = []
+        for entry in self.configuration.iter("entry"):
+            if entry.attrib.get("kind") != "sourcePath":
+                continue
+            name = entry.attrib.get("name", "").strip("/")
+            excluded = [e for e in entry.attrib.get("excluding", "").split("|") if e]
+            folder = os.path.join(self.path, name)
+            for rootdir, dirs, files in os.walk(folder):
+                relDir = os.path.relpath(rootdir, folder).replace(os.sep, "/")
+                relDir = "" if relDir == "." else relDir + "/"
+                dirs[:] = sorted(d for d in dirs if not d.startswith(".") and (relDir + d) not in excluded and
+                                 (name or relDir + d != self.BUILD_DIR))
+                for f in sorted(files):
+                    if os.path.splitext(f)[1] in self.TOOLS and relDir + f not in excluded:
+                        sources.append((name + "/" + relDir + f).lstrip("/"))
+        return sorted(set(sources))
+
+    def linkerScripts(self):
+        scripts = self.optionValues("c.linker.scriptfile") or self.optionValues("cpp.linker.scriptfile")
+        paths = self.optionValues("c.linker.paths") or self.optionValues("cpp.linker.paths") or ["../ldscripts"]
+        if not scripts:
+            scripts = [s for s in ("mem.ld", "libs.ld", "sections.ld")
+                       if os.path.exists(os.path.join(self.path, "ldscripts", s))]
+        return [self.projectPath(p) for p in paths], scripts
+
+    def toolchainFlags(self):
+        """The target, optimization, warnings and debugging flags of the configuration, given to every tool.
+        Options not set take the values of the project templates (-Og -g3 for debug, -Os for release)"""
+        release = self.configurationName.lower().startswith("release")
+        flags = list(self.cpuFlags)
+        level = self.optionValue("optimization.level")
+        level = level.split(".")[-1] if level is not None else ("size" if release else "debug")
+        if level in self.OPTIMIZATION_LEVELS:
+            flags.append(self.OPTIMIZATION_LEVELS[level])
+        flags += self.booleanFlags(self.TOOLCHAIN_FLAGS)
+        flags += self.otherFlags("optimization.other") + self.otherFlags("warnings.other")
+        debugging = self.optionValue("debugging.level")
+        debugging = debugging.split(".")[-1] if debugging is not None else ("none" if release else "max")
+        if debugging in self.DEBUGGING_LEVELS:
+            flags.append(self.DEBUGGING_LEVELS[debugging])
+        flags += self.otherFlags("debugging.other")
+        return flags
+
+    def languageStandard(self, tool):
+        """The -std flag of the C or C++ compiler (-std=gnu11 or -std=gnu++11 if not set)"""
+        value = self.optionValue(tool + ".std")
+        if value is None:
+            return ["-std=gnu11" if tool == "c.compiler" else "-std=gnu++11"]
+        standard = value.split(".")[-1]
+        if standard == "default":
+            return []
+        if standard == "ansi":
+            return ["-ansi"]
+        return ["-std=%s" % standard.replace("gnucpp", "gnu++").replace("cpp", "c++")]
+
+    def compileFlags(self, tool):
+        """The flags compiling a source with the given tool, except the input and output files"""
+        flags = self.toolchainFlags()
+        if tool == "assembler":
+            flags += ["-x", "assembler-with-cpp"]
+        else:
+            flags += self.languageStandard(tool)
+            if tool == "cpp.compiler":
+                flags += self.booleanFlags(self.CPP_FLAGS)
+            flags += self.otherFlags(tool + ".otherwarnings")
+        flags += self.otherFlags(tool + ".other")
+        flags += ["-D%s" % macro for macro in self.macros[tool]]
+        flags += ["-I%s" % include for include in self.includes[tool]]
+        return flags
+
+    def linkFlags(self):
+        # The C++ linker settings are used by projects with C++ sources
+        linker = "cpp." if any(self.tool(source) == "cpp.compiler" for source in self.sources) else "c."
+        paths, scripts = self.linkerScripts()
+        return self.toolchainFlags() + ["-L%s" % p for p in paths] + ["-T%s" % s for s in scripts] + \
+            self.booleanFlags(self.LINKER_FLAGS, linker) + self.otherFlags(linker + "linker.other") + \
+            ["-Wl,-Map,%s/%s.map" % (self.BUILD_DIR, self.name)]
+
+    def objectFile(self, source):
+        return "%s/obj/%s.o" % (self.BUILD_DIR, source)
+
+    def compiler(self, tool):
+        return "arm-none-eabi-g++" if tool == "cpp.compiler" else "arm-none-eabi-gcc"
+
+    def tool(self, source):
+        return self.TOOLS[os.path.splitext(source)[1]]
+
+    @staticmethod
+    def shellQuote(arg):
+        if re.match(r"^[\w@%+=:,./-]+$", arg):
+            return arg
+        return "'" + arg.replace("'", "'\"'\"'") + "'"
+
+    @staticmethod
+    def ninjaEscape(path):
+        return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+    def ninja(self):
+        """The content of a build.ninja file, with one build statement per source and gcc depfiles"""
+        rules = {"c.compiler": "cc", "cpp.compiler": "cxx", "assembler": "as"}
+        lines = ["# Generated by cubemximporter from the '%s' configuration of the Eclipse project" %
+                 self.configurationName, "", "ninja_required_version = 1.3", "builddir = %s" % self.BUILD_DIR, ""]
+        for tool, rule in sorted(rules.items(), key=lambda item: item[1]):
+            lines += ["%sflags = %s" % (rule, " ".join(self.shellQuote(f) for f in self.compileFlags(tool)))]
+        lines += ["ldflags = %s" % " ".join(self.shellQuote(f) for f in self.linkFlags()), ""]
+        for tool, rule in sorted(rules.items(), key=lambda item: item[1]):
+            lines += ["rule %s" % rule,
+                      "  command = %s -MMD -MP -MF $out.d $%sflags -c $in -o $out" % (self.compiler(tool), rule),
+                      "  depfile = $out.d", "  deps = gcc", "  description = %s $in" % rule.upper(), ""]
+        lines += ["rule link", "  command = arm-none-eabi-g++ $ldflags -o $out @$out.rsp", "  rspfile = $out.rsp",
+                  "  rspfile_content = $in", "  description = LINK $out", ""]
+
+        objects = []
+        for source in self.sources:
+            objects.append(self.ninjaEscape(self.objectFile(source)))
+            lines.append("build %s: %s %s" % (objects[-1], rules[self.tool(source)], self.ninjaEscape(source)))
+        elf = "%s/%s.elf" % (self.BUILD_DIR, self.ninjaEscape(self.name))
+        lines += ["", "build %s: link %s" % (elf, " ".join(objects)), "", "default %s" % elf, ""]
+        return "\n".join(lines)
+
+    def cmake(self):
+        """The content of a CMakeLists.txt building the project with the arm-none-eabi toolchain"""
+        languages = {"c.compiler": "C", "cpp.compiler": "CXX", "assembler": "ASM"}
+        target = self.name + ".elf"
+
+        def quote(value):
+            return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+        lines = ["# Generated by cubemximporter from the '%s' configuration of the Eclipse project" %
+                 self.configurationName,
+                 "cmake_minimum_required(VERSION 3.13)", "",
+                 "set(CMAKE_SYSTEM_NAME Generic)", "set(CMAKE_SYSTEM_PROCESSOR arm)",
+                 "set(CMAKE_C_COMPILER arm-none-eabi-gcc)", "set(CMAKE_CXX_COMPILER arm-none-eabi-g++)",
+                 "set(CMAKE_ASM_COMPILER arm-none-eabi-gcc)", "set(CMAKE_TRY_COMPILE_TARGET_TYPE STATIC_LIBRARY)",
+                 "set(CMAKE_EXPORT_COMPILE_COMMANDS ON)", "",
+                 "project(%s C CXX ASM)" % quote(self.name), "",
+                 "add_executable(%s" % quote(target)]
+        lines += ["    %s" % quote(source) for source in self.sources]
+        lines += [")", ""]
+
+        for tool, language in sorted(languages.items(), key=lambda item: item[1]):
+            flags = [f for f in self.compileFlags(tool) if not f.startswith(("-D", "-I"))]
+            genex = "$<$<COMPILE_LANGUAGE:%s>:%%s>" % language
+            lines += ["target_compile_options(%s PRIVATE" % quote(target)]
+            lines += ["    %s" % quote(genex % f) for f in flags]
+            lines += [")", "target_compile_definitions(%s PRIVATE" % quote(target)]
+            lines += ["    %s" % quote(genex % m) for m in self.macros[tool]]
+            lines += [")", "target_include_directories(%s PRIVATE" % quote(target)]
+            lines += ["    %s" % quote(genex % ("${CMAKE_CURRENT_SOURCE_DIR}/" + i)) for i in self.includes[tool]]
+            lines += [")", ""]
+
+        linkFlags = [f.replace("-L", "-L${CMAKE_CURRENT_SOURCE_DIR}/", 1) if f.startswith("-L") else f
+                     for f in self.linkFlags() if not f.startswith("-Wl,-Map")]
+        lines += ["target_link_options(%s PRIVATE" % quote(target)]
+        lines += ["    %s" % quote(f) for f in linkFlags + ["-Wl,-Map,${CMAKE_CURRENT_BINARY_DIR}/%s.map" % self.name]]
+        lines += [")", ""]
+        return "\n".join(lines)
+
+    def compileCommands(self):
+        """The content of a compile_commands.json, for clangd and the other tools based on it"""
+        commands = []
+        for source in self.sources:
+            tool = self.tool(source)
+            commands.append({"directory": self.path, "file": source, "output": self.objectFile(source),
+                             "arguments": [self.compiler(tool)] + self.compileFlags(tool) +
+                             ["-c", source, "-o", self.objectFile(source)]})
+        return json.dumps(commands, indent=1) + "\n"
+
+
+class UnityBuild(object):
+    """Groups the HAL and each middleware sources of the Eclipse project in 'batches' unity (jumbo) files,
+    each one compiled as a single translation unit. A source defining the same static symbols or macros
+    of the ones already in its batch, or using a macro they define, is compiled on its own"""
+
+    FOLDER = "system/src/unity"
+
+    COMMENT = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+    STATIC = re.compile(r"^static\s[^;={}()]*?\b(\w+)\s*[\[(=;]", re.MULTILINE)
+    DEFINE = re.compile(r"^\s*#\s*define\s+(\w+)", re.MULTILINE)
+    UNDEF = re.compile(r"^\s*#\s*undef\s+(\w+)", re.MULTILINE)
+    IDENTIFIER = re.compile(r"\b[A-Za-z_]\w*\b")
+    INCLUDE = re.compile(r'^#include "([^"]+)"', re.MULTILINE)
+
+    def __init__(self, root, halType, batches):
+        super(UnityBuild, self).__init__()
+
+        self.root = root
+        self.halFolder = "system/src/stm32%sxx/" % halType.lower()
+        self.batches = batches
+
+    def groups(self, sources):
+        """Group the C sources of the HAL and of each middleware (e.g. FreeRTOS), as (name, sources) pairs"""
+        groups = {}
+        for source in sources:
+            if not source.endswith(".c"):
+                continue
+            if source.startswith(self.halFolder):
+                groups.setdefault("hal", []).append(source)
+            elif source.startswith("Middlewares/"):
+                parts = source.split("/")
+                groups.setdefault(parts[2] if len(parts) > 3 else parts[1], []).append(source)
+        return sorted(groups.items())
+
+    def symbols(self, source):
+        """The static symbols, the macros left defined and the identifiers of a source"""
+        with open(os.path.join(self.root, source), "rb") as f:
+            content = self.COMMENT.sub(" ", f.read().decode("latin-1"))
+        macros = set(self.DEFINE.findall(content)) - set(self.UNDEF.findall(content))
+        return set(self.STATIC.findall(content)), macros, set(self.IDENTIFIER.findall(content))
+
+    @staticmethod
+    def join(batch, symbols):
+        """Add a source to a (members, statics, macros) batch, unless it collides with it"""
+        members, statics, macros = batch
+        source, (sourceStatics, sourceMacros, identifiers) = symbols
+        if sourceStatics & statics or sourceMacros & macros or macros & identifiers:
+            return False
+        members.append(source)
+        statics |= sourceStatics
+        macros |= sourceMacros
+        return True
+
+    def split(self, sources):
+        """Split the sources in batches of similar size. Returns the batches, the sources colliding with the
+        other sources of their batch, and the ones left alone, too few to make a batch"""
+        count = max(1, min(self.batches, len(sources) // 2))
+        symbols = dict((source, self.symbols(source)) for source in sources)
+        batches = []
+        collisions = []
+        carried = []  # A source left alone in its batch joins the next one
+        for number in range(count):
+            batch = ([], set(), set())
+            for source in carried + sources[len(sources) * number // count:len(sources) * (number + 1) // count]:
+                if not self.join(batch, (source, symbols[source])):
+                    collisions.append(source)
+            if len(batch[0]) > 1:
+                batches.append(batch)
+                carried = []
+            else:
+                carried = batch[0]
+
+        # The last source left alone joins the previous batch
+        alone = []
+        for source in carried:
+            if not batches:
+                alone.append(source)
+            elif not self.join(batches[-1], (source, symbols[source])):
+                collisions.append(source)
+        return [batch[0] for batch in batches], sorted(collisions), alone
+
+    def writeUnityFile(self, name, sources):
+        """Write a unity file including the given sources, returning its path"""
+        path = os.path.join(self.root, self.FOLDER, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        lines = ["/* Generated by cubemximporter: these sources are excluded from the build and compiled here */"]
+        lines += ['#include "%s"' % os.path.relpath(os.path.join(self.root, source), os.path.dirname(path)).replace(
+            os.sep, "/") for source in sources]
+        writeIfChanged(path, "\n".join(lines) + "\n")
+        return path
+
+    def unityFiles(self):
+        folder = os.path.join(self.root, self.FOLDER)
+        if not os.path.isdir(folder):
+            return []
+        return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith(".c")]
+
+    def previousSources(self):
+        """The project relative paths of the sources grouped in the existing unity files"""
+        sources = []
+        for path in self.unityFiles():
+            with open(path) as f:
+                for include in self.INCLUDE.findall(f.read()):
+                    sources.append(os.path.relpath(os.path.normpath(os.path.join(os.path.dirname(path), include)),
+                                                   self.root).replace(os.sep, "/"))
+        return sources
+
+    def removeUnityFiles(self, keep=()):
+        for path in self.unityFiles():
+            if path not in keep:
+                os.remove(path)
+        folder = os.path.join(self.root, self.FOLDER)
+        if os.path.isdir(folder) and not os.listdir(folder):
+            os.rmdir(folder)
+
+
+class IncludeScanner(object):
+    """Follows the #include directives of the Eclipse project sources to find the include paths they need"""
+
+    FILENAME = ".cubemximporter.includes"
+
+    DIRECTIVE = re.compile(r'^\s*(?:#\s*include\s*(?:"([^"]+)"|<([^>]+)>|([A-Za-z_]\w*))|\.include\s+"([^"]+)")',
+                           re.MULTILINE)
+
+    def __init__(self, eclipseprojectpath):
+        super(IncludeScanner, self).__init__()
+
+        self.root = os.path.abspath(eclipseprojectpath)
+        self.path = os.path.join(eclipseprojectpath, self.FILENAME)
+        self.directives = {}  # Maps the project relative path of every file to its [size, mtime, directives]
+        self.includes = {}  # Maps every configuration and tool to the include paths considered by the last scan
+        self.parsed = 0
+        self.files = {}  # Caches the existence of the files looked for while resolving the directives
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+            if cache.get("version") == version:
+                self.directives = cache["files"]
+                self.includes = cache["includes"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def candidates(self, configuration, tool, option):
+        """The include paths (as stored in the project) of a tool to scan: the current ones and the ones
+        removed by the previous scan, in their original order. None if the tool has no include paths option"""
+        if option is None:
+            return None
+        current = [o.attrib.get("value") for o in option]
+        previous = self.includes.get(configuration, {}).get(tool, {})
+        used = previous.get("used", [])
+        # Paths removed by hand from the project are not brought back
+        includes = [i for i in previous.get("paths", []) if i in current or i not in used]
+        includes += [i for i in current if i not in includes]
+        return includes
+
+    def parse(self, relPath):
+        """The (name, quoted) directives of a file, None for a computed #include. Parsed only if changed"""
+        st = os.stat(os.path.join(self.root, relPath))
+        entry = self.directives.get(relPath)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+            with open(os.path.join(self.root, relPath), "rb") as f:
+                content = f.read().decode("latin-1")
+            directives = []
+            for quoted, angled, macro, assembler in self.DIRECTIVE.findall(content):
+                if macro:
+                    directives.append(None)
+                else:
+                    directives.append((quoted or assembler or angled, bool(quoted or assembler)))
+            entry = self.directives[relPath] = [st.st_size, st.st_mtime, directives]
+            self.parsed += 1
+        return [tuple(d) if d is not None else None for d in entry[2]]
+
+    def isFile(self, path):
+        if path not in self.files:
+            self.files[path] = os.path.isfile(path)
+        return self.files[path]
+
+    def usedIncludes(self, configuration, tool, sources, includes, projectPath):
+        """Find the include paths (among 'includes', as stored in the project) needed by the given sources,
+        keeping their order. Paths outside the project, or depending on Eclipse variables, are always kept,
+        as are all the paths if a source has a computed #include"""
+        folders = []
+        for include in includes:
+            folder = projectPath(include.strip('"'))
+            folders.append(None if "${" in folder else os.path.normpath(os.path.join(self.root, folder)))
+        used = set(i for i, folder in enumerate(folders)
+                   if folder is None or not folder.startswith(self.root + os.sep) and folder != self.root)
+
+        pending = list(sources)
+        visited = set(pending)
+        while pending:
+            relPath = pending.pop()
+            fileDir = os.path.dirname(os.path.join(self.root, relPath))
+            for directive in self.parse(relPath):
+                if directive is None:
+                    used = set(range(len(includes)))
+                    continue
+                name, quoted = directive
+                found = None
+                if quoted and self.isFile(os.path.join(fileDir, name)):
+                    found = os.path.join(fileDir, name)
+                else:
+                    for i, folder in enumerate(folders):
+                        if folder is not None and self.isFile(os.path.join(folder, name)):
+                            found = os.path.join(folder, name)
+                            used.add(i)
+                            break
+                if found is None:
+                    continue  # A header of the toolchain
+                found = os.path.relpath(os.path.normpath(found), self.root).replace(os.sep, "/")
+                if found not in visited and not found.startswith("../"):
+                    visited.add(found)
+                    pending.append(found)
+
+        usedIncludes = [include for i, include in enumerate(includes) if i in used]
+        self.includes.setdefault(configuration, {})[tool] = {"paths": includes, "used": usedIncludes}
+        return usedIncludes
+
+    def save(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"version": version, "files": self.directives, "includes": self.includes}, f)
+        replaceFile(tmpPath, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Low-layer drivers used internally by HAL modules
+HAL_LL_DEPENDENCIES = {
+    "sd": ("sdmmc",),
+    "mmc": ("sdmmc",),
+    "sdram": ("fmc", "fsmc"),
+    "sram": ("fmc", "fsmc"),
+    "nand": ("fmc", "fsmc"),
+    "nor": ("fmc", "fsmc"),
+    "pccard": ("fmc", "fsmc"),
+    "pcd": ("usb",),
+    "hcd": ("usb",),
+}
+
+
+# FreeRTOS GCC port used by each STM32 family, when it can't be deduced from the SW4STM32 project
+FREERTOS_GCC_PORTS = {
+    "F0": "ARM_CM0", "L0": "ARM_CM0", "G0": "ARM_CM0",
+    "F1": "ARM_CM3", "F2": "ARM_CM3", "L1": "ARM_CM3",
+    "F3": "ARM_CM4F", "F4": "ARM_CM4F", "L4": "ARM_CM4F", "G4": "ARM_CM4F",
+    "F7": "ARM_CM7/r0p1", "H7": "ARM_CM7/r0p1",
+}
+
+
+# Cortex-M core of each STM32 family, used to generate command line builds
+HAL_CPUS = {
+    "F0": "cortex-m0", "G0": "cortex-m0plus", "L0": "cortex-m0plus",
+    "F1": "cortex-m3", "F2": "cortex-m3", "L1": "cortex-m3",
+    "F3": "cortex-m4", "F4": "cortex-m4", "G4": "cortex-m4", "L4": "cortex-m4",
+    "F7": "cortex-m7", "H7": "cortex-m7",
+}
 
 
 class CubeMXImporter(object):
     """docstring for CubeMXImporter"""
 
+    IMPORT_PHASES = ("deleteOriginalEclipseProjectFiles", "importApplication", "importHAL", "importCMSIS",
+                     "importMiddlewares")
+
     def __init__(self):
         super(CubeMXImporter, self).__init__()
 
         self.eclipseprojectpath = ""
         self.dryrun = 0
+        self.incremental = False
+        self.manifest = None
+        self.copier = CopyEngine()
+        self.copyTimes = {}  # Time spent by the copy engine threads in the copies of each phase
+        self.sources = SourceFiles()
+        self.cubemxinputpath = None
+        self.firmwarepackage = None
+        self.firmwarepath = None
+        self.store = None
+        self.sw4stm32project = None
+        self.halModulesMode = "all"
+        self.pruneMiddlewares = True
+        self.buildFiles = False
+        self.unityBatches = 0
+        self.minimalIncludes = False
+        self.plan = ImportPlan()
+        self.stats = ImportStats()
+        self.projectMtime = None
         self.logger = logging.getLogger(__name__)
         self.HAL_TYPE = None
 
     def setCubeMXProjectPath(self, path):
-        """Set the path of CubeMX generated project folder"""
+        """Set the path of CubeMX generated project folder, or of a zip or tar archive containing it"""
 
-        if os.path.exists(os.path.join(path, ".mxproject")):
-            if os.path.exists(os.path.join(path, "SW4STM32")):  # For CubeMX < 4.14
+        self.cubemxinputpath = path
+        if SourceFiles.isArchive(path):
+            path = self.sources.mount(path)
+
+        if self.sources.exists(os.path.join(path, ".mxproject")):
+            if self.sources.exists(os.path.join(path, "SW4STM32")):  # For CubeMX < 4.14
                 self.cubemxprojectpath = path
                 self.sw4stm32projectpath = os.path.join(path, "SW4STM32")
+                self.projectIndex = ProjectIndex(self.cubemxprojectpath, self.sw4stm32projectpath, self.sources)
                 self.detectHALInfo()
-            elif os.path.exists(os.path.join(path, ".cproject")):
+            elif self.sources.exists(os.path.join(path, ".cproject")):
                 # Recent releases of CubeMX (from 4.14 and higher) allow to generate the
                 # SW4STM32 project in the root folder. This means that project files are
                 # stored in the root of the CubeMX project, but this is the
                 # same behavior for TrueSTUDIO project. So we need to check if the project
                 # is generated for the SW4STM32 toolchain by playing with the content of .cproject file
 
-                if open(os.path.join(path, ".cproject")).read().find("ac6") < 0:  # It is not an AC6 project
+                project = SW4STM32Project(os.path.join(path, ".cproject"), self.sources)
+                if not project.isAC6:  # It is not an AC6 project
                     raise InvalidSW4STM32Project(
                         "The generated CubeMX project is not for SW4STM32 tool-chain. Please, regenerate the project again.")
                 else:
+                    self.sw4stm32project = project  # Already parsed, no need to read it again
                     self.cubemxprojectpath = path
                     self.sw4stm32projectpath = path
+                    self.projectIndex = ProjectIndex(self.cubemxprojectpath, self.sw4stm32projectpath, self.sources)
                     self.detectHALInfo()
 
             else:
@@ -74,16 +2475,42 @@ class CubeMXImporter(object):
             raise InvalidCubeMXFolder("The folder '%s' doesn't seem a CubeMX project" % path)
 
     def getCubeMXProjectPath(self):
-        """Retrieve the path of CubeMX generated project folder"""
-        return self.cubemxprojectpath
+        """Retrieve the path of CubeMX generated project folder, or of the archive containing it"""
+        return self.cubemxinputpath
 
     cubeMXProjectPath = property(getCubeMXProjectPath, setCubeMXProjectPath)
 
+    def setFirmwarePackage(self, path):
+        """Import HAL and CMSIS files from a STM32Cube firmware package (e.g. STM32Cube_FW_F4_V1.16.0.zip,
+        or the folder where it is extracted) instead of the ones inside the CubeMX project"""
+        root = self.sources.mount(path) if SourceFiles.isArchive(path) else path
+        if not self.sources.isdir(os.path.join(root, "Drivers")):
+            raise InvalidFirmwarePackage("'%s' doesn't seem a STM32Cube firmware package" % path)
+        self.firmwarepackage = path
+        self.firmwarepath = root
+        if self.HAL_TYPE is not None:
+            self.detectHALInfo()
+
+    def getDriversPath(self):
+        """The Drivers folder HAL and CMSIS files are imported from"""
+        return os.path.join(self.firmwarepath or self.cubemxprojectpath, "Drivers")
+
+    def firmwareVersion(self):
+        """The version of the firmware package HAL and CMSIS files are imported from (e.g. V1.16.0)"""
+        if self.firmwarepath is None:
+            return self.projectIndex.firmwareVersion()
+        for path in (self.firmwarepath, self.firmwarepackage):
+            match = re.search(r"_(V\d+(\.\d+)*)", os.path.basename(path.rstrip("/" + os.sep)))
+            if match:
+                return match.group(1)
+        return "unknown"
+
     def setEclipseProjectPath(self, path):
         """Set the path of Eclipse generated project folder"""
 
         if os.path.exists(os.path.join(path, ".cproject")):
             self.eclipseprojectpath = path
+            self.manifest = ImportManifest(path, self.sources)
         else:
             raise InvalidEclipseFolder("The folder '%s' doesn't seem an Eclipse project" % path)
 
@@ -93,89 +2520,144 @@ class CubeMXImporter(object):
 
     eclipseProjectPath = property(getEclipseProjectPath, setEclipseProjectPath)
 
-    def __addOptionValuesToProject(self, values, section, quote=True):
-        if self.dryrun: return
-        """Add a list of option values into a given section in the Eclipse project file"""
-        options = self.projectRoot.xpath("//option[@superClass='%s']" % section)  # Uses XPATH to retrieve the 'section'
-        optionsValues = [o.attrib["value"] for o in
-                         options[0]]  # List all available values to avoid reinsert again the same value
-        for opt in options:
-            for v in values:
-                pattern = '"%s"' if quote else '%s'  # The way how include paths and macros are stored differs. Include paths are quoted with ""
-                if pattern % v not in optionsValues:  # Avoid to place the same include again
-                    listOptionValue = copy.deepcopy(opt[0])
-                    if quote:
-                        listOptionValue.attrib["value"] = "&quot;%s&quot;" % v  # Quote the path
-                    else:
-                        listOptionValue.attrib["value"] = "%s" % v
-                    opt.append(listOptionValue)
+    def applyProjectEdits(self, edits):
+        """Plan a batch of EclipseProjectEdits to apply to all the configurations of the Eclipse project"""
+        self.plan.add(XmlEditOperation(edits))
 
     def addAssemblerIncludes(self, includes):
         """Add a list of include paths to the Assembler section in project settings"""
-        self.__addOptionValuesToProject(includes, "ilg.gnuarmeclipse.managedbuild.cross.option.assembler.include.paths")
+        self.applyProjectEdits(EclipseProjectEdits().addIncludes(includes, ("assembler",)))
 
     def addCIncludes(self, includes):
         """Add a list of include paths to the C section in project settings"""
-        self.__addOptionValuesToProject(includes,
-                                        "ilg.gnuarmeclipse.managedbuild.cross.option.c.compiler.include.paths")
+        self.applyProjectEdits(EclipseProjectEdits().addIncludes(includes, ("c.compiler",)))
 
     def addCPPIncludes(self, includes):
         """Add a list of include paths to the CPP section in project settings"""
-        self.__addOptionValuesToProject(includes,
-                                        "ilg.gnuarmeclipse.managedbuild.cross.option.cpp.compiler.include.paths")
+        self.applyProjectEdits(EclipseProjectEdits().addIncludes(includes, ("cpp.compiler",)))
 
     def addAssemblerMacros(self, macros):
         """Add a list of macros to the CPP section in project settings"""
-        self.__addOptionValuesToProject(macros, "ilg.gnuarmeclipse.managedbuild.cross.option.assembler.defs", False)
+        self.applyProjectEdits(EclipseProjectEdits().addMacros(macros, ("assembler",)))
 
     def addCMacros(self, macros):
         """Add a list of macros to the CPP section in project settings"""
-        self.__addOptionValuesToProject(macros, "ilg.gnuarmeclipse.managedbuild.cross.option.c.compiler.defs", False)
+        self.applyProjectEdits(EclipseProjectEdits().addMacros(macros, ("c.compiler",)))
 
     def addCPPMacros(self, macros):
         """Add a list of macros to the CPP section in project settings"""
-        self.__addOptionValuesToProject(macros, "ilg.gnuarmeclipse.managedbuild.cross.option.cpp.compiler.defs", False)
+        self.applyProjectEdits(EclipseProjectEdits().addMacros(macros, ("cpp.compiler",)))
 
     def addSourceEntries(self, entries):
         """Add a list of directory to the source entries list in the eclipse project"""
-        sources = self.projectRoot.xpath("//sourceEntries")  # Uses XPATH to retrieve the 'section'
-        for source in sources:
-            for e in entries:
-                logging.debug("Adding '%s' folder to source entries" % e)
-                entry = copy.deepcopy(source[0])
-                entry.attrib["name"] = e
-                source.append(entry)
+        self.applyProjectEdits(EclipseProjectEdits().addSourceEntries(entries))
+
+    def copyFile(self, src, dst, metadata=False, link=False):
+        """Plan the copy of 'src' file to 'dst'. If 'link' is True, the file can be linked instead
+        of copied according to the configured link mode"""
+        self.plan.add(CopyOperation(src, dst, link, metadata, self.sources.getsize(src)))
 
-    def copyTree(self, src, dst, ignore=None):
+    def executeCopy(self, op):
+        """Copy a file as planned by a CopyOperation, skipping it if unchanged since the last incremental import"""
+        start = time.time()
+        try:
+            return self.__executeCopy(op)
+        finally:
+            with self.stats.lock:
+                self.copyTimes[op.phase] = self.copyTimes.get(op.phase, 0) + time.time() - start
+
+    def copyMode(self, op):
+        """How the destination of a CopyOperation is materialized, as recorded in the manifest"""
+        if op.link and self.store is not None:
+            return "store-" + ("hardlink" if self.copier.linkMode == "copy" else self.copier.linkMode)
+        if op.link and not self.sources.isArchived(op.src):
+            return self.copier.linkMode
+        return "copy"
+
+    def manifestKey(self, path):
+        """The key of a file of the Eclipse project inside the incremental manifest"""
+        return os.path.relpath(path, self.eclipseprojectpath).replace(os.sep, "/")
+
+    def __executeCopy(self, op):
+        key = self.manifestKey(op.dst)
+        mode = self.copyMode(op)
+
+        if op.unchanged:
+            logging.debug("Keeping %s: same content" % op.dst)
+            if self.incremental and not self.manifest.isUpToDate(key, op.src, op.dst, op.phase, mode):
+                self.manifest.record(key, op.src, phase=op.phase, mode=mode)
+            return None
+
+        if self.incremental and self.manifest.isUpToDate(key, op.src, op.dst, op.phase, mode):
+            logging.debug("Skipping %s: unchanged since last import" % op.dst)
+            return None
+
+        logging.debug("Copying %s to %s" % (op.src, op.dst))
+
+        digest = None
+        if op.link and self.store is not None:
+            # Vendor files are materialized from the shared store: hard-linked, unless another link mode was chosen
+            objectPath, digest = self.store.put(op.src, self.storeVersion(), self.sources)
+            copied = self.copier.materialize(objectPath, op.dst, True,
+                                             mode="hardlink" if self.copier.linkMode == "copy" else None)
+        elif self.sources.isArchived(op.src):
+            copied = self.sources.copy(op.src, op.dst, op.metadata)
+        else:
+            copied = self.copier.materialize(op.src, op.dst, op.link, op.metadata)
+        if self.incremental:
+            self.manifest.record(key, op.src, digest, op.phase, mode)
+        self.stats.add(op.phase, "filesCopied", 1)
+        self.stats.add(op.phase, "bytesCopied", copied)
+        return copied
+
+    def copyTree(self, src, dst, ignore=None, link=False):
         """Copy 'src' directory in 'dst' folder"""
         logging.debug("Copying folder '%s' to '%s'" % (src, dst))
 
-        if not self.dryrun:
-            shutil.copytree(src, dst, ignore)
+        if self.plan.willExist(dst) and not self.incremental:
+            raise OSError(errno.EEXIST, "Destination folder already exists", dst)
+
+        for rootdir, dirs, files in self.sources.walk(src):
+            ignored = ignore(rootdir, dirs + files) if ignore is not None else ()
+            dirs[:] = [d for d in dirs if d not in ignored]
+            dstdir = os.path.join(dst, os.path.relpath(rootdir, src))
+            self.plan.add(MkdirOperation(os.path.normpath(dstdir)))
+            for f in files:
+                if f not in ignored:
+                    self.copyFile(os.path.join(rootdir, f), os.path.join(dstdir, f), metadata=True, link=link)
 
-    def copyTreeContent(self, src, dst):
+    def copyTreeContent(self, src, dst, ignore=None, link=False):
         """Copy all files contsined in 'src' folder to 'dst' folder"""
-        files = os.listdir(src)
+        files = self.sources.listdir(src)
+        ignored = ignore(src, files) if ignore is not None else ()
         for f in files:
+            if f in ignored:
+                continue
             fileToCopy = os.path.join(src, f)
-            if os.path.isfile(fileToCopy):
-                logging.debug("Copying %s to %s" % (fileToCopy, dst))
-                if not self.dryrun:
-                    shutil.copyfile(fileToCopy, os.path.join(dst, f))
-            elif os.path.isdir(fileToCopy):
+            if self.sources.isfile(fileToCopy):
+                self.copyFile(fileToCopy, os.path.join(dst, f), link=link)
+            elif self.sources.isdir(fileToCopy):
                 logging.debug("Copying folder %s to %s" % (fileToCopy, dst))
-                if not self.dryrun:
-                    shutil.copytree(fileToCopy, os.path.join(dst, f))
+                self.copyTree(fileToCopy, os.path.join(dst, f), link=link)
+
+    def removeStaleFiles(self):
+        """Remove the files imported by the previous incremental import that no longer exist in the CubeMX project"""
+        if not self.incremental:
+            return
+
+        planned = set(self.manifestKey(op.dst) for op in self.plan.operations if op.kind == "copy")
+        planned.update(self.manifest.current)  # Files of the phases not run again by reimport()
+        for key in sorted(set(self.manifest.previous) - planned):
+            path = os.path.join(self.eclipseprojectpath, key)
+            logging.debug("Deleting stale file %s" % path)
+            self.plan.add(DeleteOperation(path))
 
     def purge(self, rootdir, pattern):
         for f in os.listdir(rootdir):
             if re.search(pattern, f):
                 path = os.path.join(rootdir, f)
                 logging.debug("Deleting %s" % path)
-                if os.path.isfile(path):
-                    os.remove(path)
-                elif os.path.isdir(path):
-                    shutil.rmtree(path)
+                self.plan.add(DeleteOperation(path))
 
     def deleteOriginalEclipseProjectFiles(self):
         """Deletes useless files generated by the GNU ARM Eclipse plugin"""
@@ -187,13 +2669,18 @@ class CubeMXImporter(object):
         stm32_h_pat  = '(system_)*stm32%s.*.h$' % self.HAL_TYPE.lower()
 
 
-        if not self.dryrun:
-            [self.deleteTreeContent(os.path.join(self.eclipseprojectpath, d)) for d in dirs]
-            [self.purge(os.path.join(self.eclipseprojectpath, d), stm32_dir_pat) for d in dirs2]
-            self.purge(os.path.join(self.eclipseprojectpath, "system/include/cmsis/"), stm32_h_pat)
-            rdirs = [os.path.join(self.eclipseprojectpath, d, "stm32%sxx" % self.HAL_TYPE.lower()) for d in dirs2]
-            [os.makedirs(d ) for d in rdirs]
-            self.fixDeviceInclude()
+        if self.incremental and self.manifest.loaded:
+            # Files generated by the GNU ARM Eclipse plugin were already removed by the first import,
+            # while the ones imported from CubeMX are updated in place
+            self.logger.info("Incremental import: keeping files imported by the previous run")
+            return
+
+        [self.deleteTreeContent(os.path.join(self.eclipseprojectpath, d)) for d in dirs]
+        [self.purge(os.path.join(self.eclipseprojectpath, d), stm32_dir_pat) for d in dirs2]
+        self.purge(os.path.join(self.eclipseprojectpath, "system/include/cmsis/"), stm32_h_pat)
+        rdirs = [os.path.join(self.eclipseprojectpath, d, "stm32%sxx" % self.HAL_TYPE.lower()) for d in dirs2]
+        [self.plan.add(MkdirOperation(os.path.normpath(d))) for d in rdirs]
+        self.fixDeviceInclude()
         self.logger.info("Deleted unneeded files generated by GNU Eclipse plugin")
 
     def deleteTreeContent(self, tree):
@@ -201,48 +2688,50 @@ class CubeMXImporter(object):
         for f in os.listdir(tree):
             f = os.path.join(tree, f)
             logging.debug("Deleting %s" % f)
-            if not self.dryrun:
-                if os.path.isfile(f):
-                    os.unlink(f)
-                elif os.path.isdir(f):
-                    shutil.rmtree(f)
+            self.plan.add(DeleteOperation(f))
 
-    def detectHALInfo(self):
-        """Scans the SW4STM32 project file looking for relevant informations about MCU and HAL types"""
-
-        root = None
-
-        for rootdir, dirs, files in os.walk(self.sw4stm32projectpath):
-            if ".cproject" in files:
-                root = etree.fromstring(open(os.path.join(rootdir, ".cproject")).read().encode('UTF-8'))
-
-        if root is None:
+    def getSW4STM32Project(self):
+        """Retrieve the model of the SW4STM32 project file, parsing it again only if it changed"""
+        if self.projectIndex.cprojectPath is None:
             raise InvalidSW4STM32Project(
                 "The generated CubeMX project is not for SW4STM32 tool-chain. Please, regenerate the project again.")
 
-        options = root.xpath("//option[@superClass='gnu.c.compiler.option.preprocessor.def.symbols']")[0]
+        if self.sw4stm32project is None or self.sw4stm32project.path != self.projectIndex.cprojectPath:
+            self.sw4stm32project = SW4STM32Project(self.projectIndex.cprojectPath, self.sources)
+        else:
+            self.sw4stm32project.refresh()
+        return self.sw4stm32project
 
-        for opt in options:
-            if "STM32" in opt.attrib["value"]:
-                self.HAL_MCU_TYPE = opt.attrib["value"]
-                self.HAL_TYPE = re.search("([FL][0-9])", self.HAL_MCU_TYPE).group(1)
-                self.logger.info("Detected MCU type: %s" % self.HAL_MCU_TYPE)
-                self.logger.info("Detected HAL type: %s" % self.HAL_TYPE)
+    sw4stm32Project = property(getSW4STM32Project)
 
-    def getAC6Includes(self):
-        root = None
+    def detectHALInfo(self):
+        """Scans the SW4STM32 project file looking for relevant informations about MCU and HAL types"""
 
-        for rootdir, dirs, files in os.walk(self.sw4stm32projectpath):
-            if ".cproject" in files:
-                root = etree.fromstring(open(os.path.join(rootdir, ".cproject")).read().encode('UTF-8'))
+        project = self.getSW4STM32Project()
 
-        if root is None:
-            raise InvalidSW4STM32Project(
-                "The generated CubeMX project is not for SW4STM32 tool-chain. Please, regenerate the project again.")
+        if project.mcuType is not None:
+            self.HAL_MCU_TYPE = project.mcuType
+            self.HAL_TYPE = project.halType
+            self.logger.info("Detected MCU type: %s" % self.HAL_MCU_TYPE)
+            self.logger.info("Detected HAL type: %s" % self.HAL_TYPE)
 
-        options = root.xpath("//option[@superClass='gnu.c.compiler.option.include.paths']")[0]
+        if self.HAL_TYPE is not None and self.firmwarepath is not None:
+            if not self.sources.isdir(os.path.join(self.getDriversPath(), "STM32%sxx_HAL_Driver" % self.HAL_TYPE)):
+                raise InvalidFirmwarePackage("The firmware package '%s' doesn't contain the STM32%sxx HAL" % (
+                    self.firmwarepackage, self.HAL_TYPE))
+            if self.firmwareVersion() != self.projectIndex.firmwareVersion():
+                self.logger.warning("The CubeMX project was generated with the firmware %s, while HAL and CMSIS "
+                                    "files are imported from the firmware %s" % (
+                                        self.projectIndex.firmwareVersion(), self.firmwareVersion()))
 
-        return [opt.attrib["value"] for opt in options]
+        if self.HAL_TYPE is not None:
+            self.projectIndex.locateDeviceFiles(self.HAL_TYPE, self.HAL_MCU_TYPE,
+                                                self.getDriversPath() if self.firmwarepath is not None else None)
+            self.logger.info("Detected CubeMX project layout: %d" % self.projectIndex.layoutVersion)
+
+    def getAC6Includes(self):
+        """Retrieve the include paths of the SW4STM32 project"""
+        return self.getSW4STM32Project().includes
 
     def importApplication(self):
         """Import generated application code inside the Eclipse project"""
@@ -253,125 +2742,128 @@ class CubeMXImporter(object):
 
         locations = ((srcIncludeDir, dstIncludeDir), (srcSourceDir, dstSourceDir))
 
+        # From CubeMX 4.18 the system_stm32XXxx.c file is generated inside the Src folder,
+        # but importCMSIS() places it among the other CMSIS files
+        ignore = shutil.ignore_patterns("system_stm32%sxx.c" % self.HAL_TYPE.lower())
+
         for loc in locations:
-            self.copyTreeContent(loc[0], loc[1])
+            self.copyTreeContent(loc[0], loc[1], ignore)
 
         self.logger.info("Successfully imported application files")
 
     def importCMSIS(self):
         """Import CMSIS package and CMSIS-DEVICE adapter by ST inside the Eclipse project"""
-        cubeMXVersion = 417
-
-        srcIncludeDir = os.path.join(self.cubemxprojectpath,
-                                     "Drivers/CMSIS/Device/ST/STM32%sxx/Include" % self.HAL_TYPE)
+        srcIncludeDir = os.path.join(self.getDriversPath(), "CMSIS/Device/ST/STM32%sxx/Include" % self.HAL_TYPE)
         dstIncludeDir = os.path.join(self.eclipseprojectpath, "system/include/cmsis/device")
-        srcCMSISIncludeDir = os.path.join(self.cubemxprojectpath, "Drivers/CMSIS/Include")
+        srcCMSISIncludeDir = os.path.join(self.getDriversPath(), "CMSIS/Include")
         dstCMSISIncludeDir = os.path.join(self.eclipseprojectpath, "system/include/cmsis")
         dstSourceDir = os.path.join(self.eclipseprojectpath, "system/src/cmsis")
 
-        try:
-            if not self.dryrun:
-                os.mkdir(dstIncludeDir)
-        except OSError:
-            pass
+        self.plan.add(MkdirOperation(dstIncludeDir))
 
+        edits = EclipseProjectEdits()
         # Add hal includes for variants with otehr folder names
-        self.addCIncludes(("../system/include/stm32%sxx" % self.HAL_TYPE.lower(),))
-        self.addCPPIncludes(("../system/include/stm32%sxx" % self.HAL_TYPE.lower(),))
-
+        edits.addIncludes(("../system/include/stm32%sxx" % self.HAL_TYPE.lower(),), ("c.compiler", "cpp.compiler"))
         # Add includes to the project settings
-        self.addCIncludes(("../system/include/cmsis/device",))
-        self.addCPPIncludes(("../system/include/cmsis/device",))
-        self.addAssemblerIncludes(("../system/include/cmsis/device",))
+        edits.addIncludes(("../system/include/cmsis/device",))
+        self.applyProjectEdits(edits)
 
         locations = ((srcIncludeDir, dstIncludeDir), (srcCMSISIncludeDir, dstCMSISIncludeDir))
 
         for loc in locations:
-            self.copyTreeContent(loc[0], loc[1])
-
-        systemFile = os.path.join(self.cubemxprojectpath,
-                                  "Drivers/CMSIS/Device/ST/STM32%sxx/Source/Templates/system_stm32%sxx.c" % (
-                                      self.HAL_TYPE, self.HAL_TYPE.lower()))
+            self.copyTreeContent(loc[0], loc[1], link=True)
 
-        if not os.path.exists(systemFile):
-            #CubeMX 4.18 moved the system_stm32XXxx.c file inside the main src folder
-            cubeMXVersion = 418
-            systemFile = os.path.join(self.cubemxprojectpath,
-                                  "Src/system_stm32%sxx.c" % self.HAL_TYPE.lower())
+        systemFile = self.projectIndex.systemFile
+        startupFile = self.projectIndex.startupFile
 
-        startupFile = os.path.join(self.cubemxprojectpath,
-                                   "Drivers/CMSIS/Device/ST/STM32%sxx/Source/Templates/gcc/startup_%s.s" % (
-                                       self.HAL_TYPE, self.HAL_MCU_TYPE.lower()))
+        driversDirs = (os.path.join(self.cubemxprojectpath, "Drivers"), self.getDriversPath())
 
-        if not os.path.exists(startupFile):
-            #CubeMX 4.19 moved the system_stm32XXxx.s file inside the startup folder
-            cubeMXVersion = 419
-            startupFile = os.path.join(self.cubemxprojectpath,
-                                  "startup/startup_%s.s" % self.HAL_MCU_TYPE.lower())
-
-        locations = ((systemFile, dstSourceDir), (startupFile, dstSourceDir))
-
-        if not self.dryrun:
-            for loc in locations:
-                shutil.copy(loc[0], loc[1])
-
-            os.rename(
-                os.path.join(self.eclipseprojectpath, "system/src/cmsis/startup_%s.s" % self.HAL_MCU_TYPE.lower()),
-                os.path.join(self.eclipseprojectpath, "system/src/cmsis/startup_%s.S" % self.HAL_MCU_TYPE.lower()))
-
-            if cubeMXVersion >= 418:
-                os.unlink(os.path.join(self.eclipseprojectpath, "src/system_stm32%sxx.c" % self.HAL_TYPE.lower()))
+        # The startup file is imported with the .S extension, so that it is preprocessed by the GNU assembler.
+        # Only the files coming from the Drivers folder are vendor code that can be linked
+        self.copyFile(systemFile, os.path.join(dstSourceDir, os.path.basename(systemFile)),
+                      link=systemFile.startswith(driversDirs))
+        self.copyFile(startupFile, os.path.join(dstSourceDir, "startup_%s.S" % self.HAL_MCU_TYPE.lower()),
+                      link=startupFile.startswith(driversDirs))
 
         self.logger.info("Successfully imported CMSIS files")
 
     def importHAL(self):
         """Import the ST HAL inside the Eclipse project"""
-        srcIncludeDir = os.path.join(self.cubemxprojectpath, "Drivers/STM32%sxx_HAL_Driver/Inc" % self.HAL_TYPE)
-        srcSourceDir = os.path.join(self.cubemxprojectpath, "Drivers/STM32%sxx_HAL_Driver/Src" % self.HAL_TYPE)
+        srcIncludeDir = os.path.join(self.getDriversPath(), "STM32%sxx_HAL_Driver/Inc" % self.HAL_TYPE)
+        srcSourceDir = os.path.join(self.getDriversPath(), "STM32%sxx_HAL_Driver/Src" % self.HAL_TYPE)
         dstIncludeDir = os.path.join(self.eclipseprojectpath, "system/include/stm32%sxx" % self.HAL_TYPE.lower())
         dstSourceDir = os.path.join(self.eclipseprojectpath, "system/src/stm32%sxx" % self.HAL_TYPE.lower())
 
-        locations = ((srcIncludeDir, dstIncludeDir), (srcSourceDir, dstSourceDir))
-
-        for loc in locations:
-            self.copyTreeContent(loc[0], loc[1])
-
-        self.addAssemblerMacros((self.HAL_MCU_TYPE,))
-        self.addCMacros((self.HAL_MCU_TYPE,))
-        self.addCPPMacros((self.HAL_MCU_TYPE,))
+        # Skip templete files, if generated
+        templates = ("stm32%sxx_hal_msp_template.c" % self.HAL_TYPE.lower(),
+                     "stm32%sxx_hal_timebase_tim_template.c" % self.HAL_TYPE.lower())
+        sources = [f for f in self.sources.listdir(srcSourceDir) if f not in templates]
+        unneeded = set()
 
-        if not self.dryrun:
-            try:
-                # Try to delete templete files, if generated
-                os.unlink(os.path.join(self.eclipseprojectpath, "system/src/stm32%sxx/stm32%sxx_hal_msp_template.c" % (
-                    self.HAL_TYPE.lower(), self.HAL_TYPE.lower())))
-                os.unlink(os.path.join(self.eclipseprojectpath,
-                                       "system/src/stm32%sxx/stm32%sxx_hal_timebase_tim_template.c" % (
-                                           self.HAL_TYPE.lower(), self.HAL_TYPE.lower())))
-            except OSError:
-                pass
+        if self.halModulesMode != "all":
+            modules = self.getEnabledHALModules()
+            if modules is None:
+                self.logger.warning("Unable to find the HAL configuration file: importing all HAL modules")
+            else:
+                unneeded = set(f for f in sources if not self.isHALSourceNeeded(f, modules))
+                self.logger.info("Enabled HAL modules: %s (%d of %d HAL sources not needed)" % (
+                    ", ".join(sorted(modules)), len(unneeded), len(sources)))
+
+        skipped = set(templates)
+        if self.halModulesMode == "import":
+            skipped.update(unneeded)
+
+        self.copyTreeContent(srcIncludeDir, dstIncludeDir, shutil.ignore_patterns(*templates), link=True)
+        self.copyTreeContent(srcSourceDir, dstSourceDir, lambda d, files: skipped, link=True)
+
+        # Unneeded sources are excluded from the build, while the other ones are included again in case
+        # they were excluded by a previous import with a different HAL configuration
+        excluded = unneeded if self.halModulesMode == "exclude" else set()
+        halSourceDir = "system/src/stm32%sxx/" % self.HAL_TYPE.lower()
+        edits = EclipseProjectEdits().addMacros((self.HAL_MCU_TYPE,))
+        edits.includeInBuild(halSourceDir + f for f in sources if f not in excluded)
+        edits.excludeFromBuild(halSourceDir + f for f in sorted(excluded))
+        self.applyProjectEdits(edits)
 
         self.logger.info("Successfully imported the STCubeHAL")
 
+    def getEnabledHALModules(self):
+        """Parse the stm32XXxx_hal_conf.h file of the CubeMX project, returning the set of enabled HAL modules
+        (e.g. 'gpio', 'rcc', 'uart'), or None if the file doesn't exist"""
+        halConf = os.path.join(self.cubemxprojectpath, "Inc", "stm32%sxx_hal_conf.h" % self.HAL_TYPE.lower())
+        if not self.sources.exists(halConf):
+            return None
+
+        modules = set()
+        for line in self.sources.readText(halConf).splitlines():
+            match = re.match(r"\s*#\s*define\s+HAL_(\w+)_MODULE_ENABLED\b", line)
+            if match:
+                modules.add(match.group(1).lower())
+        return modules
+
+    def isHALSourceNeeded(self, filename, modules):
+        """Check if a HAL or LL source file is needed by the given set of enabled HAL modules"""
+        match = re.match(r"stm32\w\dxx_(hal|ll)_?(\w*)\.c$", filename)
+        if match is None or match.group(2) == "":  # Not a module source, or the HAL core
+            return True
+
+        # Extension files (e.g. _ex.c, _ramfunc.c) belong to the module before the first underscore
+        module = match.group(2).split("_")[0]
+        if match.group(1) == "hal":
+            return module in modules
+
+        if "USE_FULL_LL_DRIVER" in self.getSW4STM32Project().configuration().defines:
+            return True  # LL drivers are used directly by the application
+        return any(module in HAL_LL_DEPENDENCIES.get(m, ()) for m in modules)
+
     def importMiddlewares(self):
         """Import the ST HAL inside the Eclipse project"""
 
-        foundFreeRTOS = False
-        foundMiddlewares = False
-        foundFF = False
-        foundLwIP = False
-
-        for rootdir, dirs, files in os.walk(self.cubemxprojectpath):
-            if "Middlewares" in dirs:
-                foundMiddlewares = True
-            if "FreeRTOS" in dirs:
-                foundFreeRTOS = True
-            if "FatFs" in dirs:
-                foundFF = True
-            if "LwIP" in dirs:
-                foundLwIP = True
-
-        if not foundMiddlewares:
+        foundFreeRTOS = self.projectIndex.hasMiddleware("FreeRTOS")
+        foundFF = self.projectIndex.hasMiddleware("FatFs")
+        foundLwIP = self.projectIndex.hasMiddleware("LwIP")
+
+        if not self.projectIndex.hasMiddlewares():
             return
 
         srcDir = os.path.join(self.cubemxprojectpath, "Middlewares")
@@ -379,32 +2871,38 @@ class CubeMXImporter(object):
 
         locations = ((srcDir, dstDir),)
 
+        # CubeMX 4.14 no longer generates this file
+        ignore = shutil.ignore_patterns("ethernetif_template.c") if foundLwIP else None
+
         try:
             for loc in locations:
-                self.copyTree(loc[0], loc[1])
+                self.copyTree(loc[0], loc[1], ignore, link=True)
         except OSError as e:
-            import errno
             if e.errno == errno.EEXIST:
-                shutil.rmtree(dstDir)
+                self.plan.add(DeleteOperation(dstDir))
                 return self.importMiddlewares()
 
         # Adding Middleware library includes
         includes = [inc.replace("../../", "") for inc in self.getAC6Includes() if "Middlewares" in inc]
 
-        self.addCIncludes(includes)
-        self.addCPPIncludes(includes)
-        self.addAssemblerIncludes(includes)
-        self.addSourceEntries(("Middlewares",))
+        edits = EclipseProjectEdits().addIncludes(includes).addSourceEntries(("Middlewares",))
 
-        self.logger.info("Successfully imported Middlewares libraries")
+        heap = None
+        prunedFatFs = False
+        if self.pruneMiddlewares:
+            if foundFreeRTOS:
+                heap = self.pruneFreeRTOS(edits)
+            if foundFF:
+                prunedFatFs = self.pruneFatFs(edits)
+        else:
+            # Build again the files excluded by a previous import with pruning enabled
+            for folder in ("Middlewares/Third_Party/FreeRTOS/Source/portable",
+                           "Middlewares/Third_Party/FatFs/src/option"):
+                edits.includeInBuild(self.projectOptions.excludedFromBuild(folder))
 
-        if foundLwIP:
-            try:
-                ethernetif_template = os.path.join(self.eclipseprojectpath,
-                                                   "Middlewares/Third_Party/LwIP/src/netif/ethernetif_template.c")
-                os.unlink(ethernetif_template)
-            except OSError:  # CubeMX 4.14 no longer generates this file
-                pass
+        self.applyProjectEdits(edits)
+
+        self.logger.info("Successfully imported Middlewares libraries")
 
         if foundFreeRTOS:
             print("#" * 100)
@@ -415,10 +2913,11 @@ class CubeMXImporter(object):
             print("""The original CubeMX project contains the FreeRTOS middleware library. 
 This library was imported in the Eclipse project correctly, but you still need to
 configure your tool-chain 'Float ABI' and 'FPU Type' if your STM32 support hard float 
-(e.g. for a STM32F4 MCU set 'Float ABI'='FP Instructions(hard)'' and 'FPU Type'='fpv4-sp-d16'. 
-Moreover, exclude from build those MemManage files (heap_1.c, etc) not needed for your project.""")
+(e.g. for a STM32F4 MCU set 'Float ABI'='FP Instructions(hard)'' and 'FPU Type'='fpv4-sp-d16'.""")
+            if heap is None:
+                print("Moreover, exclude from build those MemManage files (heap_1.c, etc) not needed for your project.")
 
-        if foundFF:
+        if foundFF and not prunedFatFs:
             print("#" * 100)
             print("####", end="")
             print("READ CAREFULLY".center(92), end="")
@@ -428,50 +2927,370 @@ Moreover, exclude from build those MemManage files (heap_1.c, etc) not needed fo
 This library was imported in the Eclipse project correctly, but you still need to
 exclude from build those uneeded codepage files (cc932.c, etc) not needed for your project.""")
 
+    def __pruneFolder(self, edits, folder, keep):
+        """Exclude from the build all the entries of a Middlewares 'folder' except the ones in 'keep',
+        which are included again in case they were excluded by a previous import"""
+        srcFolder = os.path.join(self.cubemxprojectpath, folder)
+        if not self.sources.isdir(srcFolder):
+            return []
+
+        excluded = []
+        for f in sorted(self.sources.listdir(srcFolder)):
+            if f in keep:
+                edits.includeInBuild((folder + "/" + f,))
+            else:
+                edits.excludeFromBuild((folder + "/" + f,))
+                excluded.append(f)
+        return excluded
+
+    def getFreeRTOSHeap(self):
+        """Detect the FreeRTOS memory management scheme (heap_N.c) chosen in CubeMX, or None if unknown"""
+        sources = ((os.path.join(self.cubemxprojectpath, "Inc", "FreeRTOSConfig.h"), r"\bUSE_FreeRTOS_HEAP_([1-5])\b"),
+                   (self.projectIndex.iocPath, r"^FREERTOS\.\w*HEAP\w*=\D*([1-5])\s*$"),
+                   (os.path.join(self.cubemxprojectpath, ".mxproject"), r"\bheap_([1-5])\.c\b"))
+
+        for path, pattern in sources:
+            if path is not None and self.sources.exists(path):
+                match = re.search(pattern, self.sources.readText(path), re.MULTILINE | re.IGNORECASE)
+                if match:
+                    return "heap_%s.c" % match.group(1)
+        return None
+
+    def getFreeRTOSPort(self):
+        """Detect the FreeRTOS GCC port (e.g. ARM_CM4F) for the MCU core"""
+        for inc in self.getAC6Includes():
+            match = re.search(r"FreeRTOS/Source/portable/GCC/(ARM_CM\w+(/r\dp\d)?)", inc)
+            if match:
+                return match.group(1)
+        return FREERTOS_GCC_PORTS.get(self.HAL_TYPE)
+
+    def pruneFreeRTOS(self, edits):
+        """Exclude from the build the FreeRTOS memory managers and ports not used by the project.
+        Returns the heap_N.c file used, or None if it can't be detected"""
+        portable = "Middlewares/Third_Party/FreeRTOS/Source/portable"
+
+        heapFiles = [f for f in self.sources.listdir(os.path.join(self.cubemxprojectpath, portable, "MemMang"))
+                     if re.match(r"heap_\d\.c$", f)] if self.sources.isdir(
+            os.path.join(self.cubemxprojectpath, portable, "MemMang")) else []
+        heap = heapFiles[0] if len(heapFiles) == 1 else self.getFreeRTOSHeap()
+        if heap is not None:
+            self.__pruneFolder(edits, portable + "/MemMang", (heap,))
+            self.logger.info("Using FreeRTOS memory manager %s" % heap)
+        else:
+            self.logger.warning("Unable to detect the FreeRTOS memory manager: all heap_N.c files are built")
+
+        # Only the GCC port for the MCU core is built
+        self.__pruneFolder(edits, portable, ("GCC", "MemMang", "Common"))
+        port = self.getFreeRTOSPort()
+        if port is not None:
+            folder = portable + "/GCC"
+            for part in port.split("/"):
+                self.__pruneFolder(edits, folder, (part,))
+                folder += "/" + part
+            self.logger.info("Using FreeRTOS port GCC/%s" % port)
+
+        return heap
+
+    def getFatFsConfiguration(self):
+        """Parse the ffconf.h file of the CubeMX project, returning the (use LFN, code page) tuple, or None"""
+        for folder in ("Inc", "FATFS/Target", "FATFS/App"):
+            ffconf = os.path.join(self.cubemxprojectpath, folder, "ffconf.h")
+            if self.sources.exists(ffconf):
+                content = self.sources.readText(ffconf)
+                lfn = re.search(r"^\s*#define\s+_?(?:FF)?_USE_LFN\s+(\d+)", content, re.MULTILINE)
+                codePage = re.search(r"^\s*#define\s+_?(?:FF)?_CODE_PAGE\s+(\d+)", content, re.MULTILINE)
+                return (int(lfn.group(1)) if lfn else 0, int(codePage.group(1)) if codePage else None)
+        return None
+
+    def pruneFatFs(self, edits):
+        """Exclude from the build the FatFs code page files not used by the project.
+        Returns False if the FatFs configuration can't be detected"""
+        option = "Middlewares/Third_Party/FatFs/src/option"
+        srcOption = os.path.join(self.cubemxprojectpath, option)
+        if not self.sources.isdir(srcOption):
+            return True  # No code page files to build
+        configuration = self.getFatFsConfiguration()
+        if configuration is None:
+            self.logger.warning("Unable to find the FatFs ffconf.h: all code page files are built")
+            return False
+
+        useLFN, codePage = configuration
+        files = self.sources.listdir(srcOption)
+        codePageFiles = [f for f in files if re.match(r"cc(\d+|sbcs)\.c$", f)]
+        keep = set(f for f in files if f not in codePageFiles)
+
+        # unicode.c includes the right code page file by itself, so they are never built directly
+        if useLFN and "unicode.c" not in files:
+            keep.add("cc%d.c" % codePage if codePage is not None and "cc%d.c" % codePage in codePageFiles
+                     else "ccsbcs.c")
+
+        excluded = self.__pruneFolder(edits, option, keep)
+        self.logger.info("Excluded FatFs code page files not needed for code page %s: %s" % (
+            codePage, ", ".join(excluded)))
+        return True
+
     def patchMEM_LDFile(self):
         """ Fix the FLASH starting address if set to 0x00000000 """
-
-        memLD_File = os.path.join(self.eclipseprojectpath, "ldscripts", "mem.ld")
-        
-        fcontent = open(memLD_File, "r+").readlines()
-        changed = False
-        for i in range(len(fcontent)):
-             if re.search("FLASH .([r,x])", fcontent[i]):
-                 fcontent[i] = fcontent[i].replace("00000000", "08000000")
-                 changed = True
-
-        if changed and not self.dryrun:
-            open(memLD_File, "w+").writelines(fcontent)
-
-        if changed:
-            self.logger.info("Changed the FLASH region starting address from 0x00000000 to 0x08000000")
+        self.patchFiles([PatchRule("ldscripts/mem.ld", "00000000", "08000000", when="FLASH .([r,x])", literal="FLASH",
+                                   description="Changed the FLASH region starting address from 0x00000000 to 0x08000000")])
+
+    def generateUnityBuild(self):
+        """Plan the grouping of HAL and middleware sources in unity files, if enabled. Otherwise, the unity
+        files of a previous import are removed"""
+        if self.unityBatches or os.path.isdir(os.path.join(self.eclipseprojectpath, UnityBuild.FOLDER)):
+            self.plan.add(UnityBuildOperation(self.eclipseprojectpath, self.unityBatches))
+
+    def pruneIncludePaths(self):
+        """Plan the removal of the include paths not needed by the sources, if enabled. Otherwise, the ones
+        removed by a previous import are restored"""
+        if self.minimalIncludes or os.path.exists(os.path.join(self.eclipseprojectpath, IncludeScanner.FILENAME)):
+            self.plan.add(IncludePathsOperation(self.eclipseprojectpath, self.minimalIncludes))
+
+    def generateBuildFiles(self):
+        """Plan the generation of build.ninja, CMakeLists.txt and compile_commands.json, if enabled. Otherwise,
+        the ones generated by a previous import are removed"""
+        if self.buildFiles or BuildFilesOperation.generated(self.eclipseprojectpath):
+            self.plan.add(BuildFilesOperation(self.eclipseprojectpath, self.buildFiles))
+
+    def patchFiles(self, rules):
+        """Plan the patch of the Eclipse project files matched by the given PatchRules, once all files are copied"""
+        self.plan.add(TextPatchOperation(PatchSet(rules), self.eclipseprojectpath))
 
     def parseEclipseProjectFile(self):
         """Parse the Eclipse XML project file"""
         projectFile = os.path.join(self.eclipseprojectpath, ".cproject")
+        self.projectMtime = os.stat(projectFile).st_mtime
         self.projectRoot = etree.fromstring(open(projectFile).read().encode('UTF-8'))
+        self.projectOptions = EclipseProjectOptions(self.projectRoot)
 
     def printEclipseProjectFile(self):
         """Do a pretty print of Eclipse project DOM"""
-        xmlout = etree.tostring(self.projectRoot, pretty_print=True)
-        # lxml correctly escapes the "&" to "&amp;", as specified by the XML standard.
-        # However, Eclipse expects that the " charachter is espressed as &quot; So,
-        # here we replace the "&amp;" with "&" in the final XML file
-        xmlout = xmlout.replace("&amp;", "&")
-        print(xmlout)
+        print(etree.tostring(self.projectRoot, pretty_print=True).decode('UTF-8'))
 
     def saveEclipseProjectFile(self):
-        """Save the XML DOM of Eclipse project inside the .cproject file"""
-
-        xmlout = '<?xml version="1.0" encoding="UTF-8" standalone="no"?><?fileVersion 4.0.0?>' + etree.tostring(
-            self.projectRoot).decode('UTF-8')
-        # lxml correctly escapes the "&" to "&amp;", as specified by the XML standard.
-        # However, Eclipse expects that the " charachter is espressed as &quot; So,
-        # here we replace the "&amp;" with "&" in the final XML file
-        xmlout = xmlout.replace("&amp;", "&")
+        """Plan the save of the XML DOM of Eclipse project inside the .cproject file"""
+        self.plan.add(XmlWriteOperation(os.path.join(self.eclipseprojectpath, ".cproject")))
+
+    def writeEclipseProjectFile(self):
+        """Write the XML DOM of Eclipse project inside the .cproject file.
+
+        The DOM is streamed to a temporary file that atomically replaces the .cproject file, so that
+        a crash never leaves a truncated project. If the content didn't change, the .cproject file is
+        left untouched, so that Eclipse doesn't index the project again"""
+
         projectFile = os.path.join(self.eclipseprojectpath, ".cproject")
+        fd, tmpPath = tempfile.mkstemp(prefix=".cproject.", suffix=".tmp", dir=self.eclipseprojectpath)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(b'<?xml version="1.0" encoding="UTF-8" standalone="no"?><?fileVersion 4.0.0?>')
+                with etree.xmlfile(f, encoding="UTF-8") as xf:
+                    xf.write(self.projectRoot)
+
+            if filecmp.cmp(tmpPath, projectFile, shallow=False):
+                os.remove(tmpPath)
+                self.logger.info("Eclipse project settings unchanged")
+                return
+
+            shutil.copymode(projectFile, tmpPath)
+            replaceFile(tmpPath, projectFile)
+            self.projectMtime = os.stat(projectFile).st_mtime
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        self.logger.info("Saved Eclipse project settings")
+
+    def runImport(self, phases=IMPORT_PHASES):
+        """Run the given import phases, then apply the planned operations and save the Eclipse project"""
+        for phase in tuple(phases) + ("removeStaleFiles", "saveEclipseProjectFile", "patchMEM_LDFile",
+                                      "generateUnityBuild", "pruneIncludePaths", "generateBuildFiles", "executePlan",
+                                      "addSharedStoreReference",
+                                      "saveImportStamp"):
+            self.runPhase(phase)
+
+    def affectedPhases(self, paths):
+        """Map the paths (relative to the CubeMX project) of changed files to the import phases reading them.
+        Returns None if the whole project must be imported again, e.g. when the SW4STM32 project changed"""
+        hal = self.HAL_TYPE.lower()
+        phases = set()
+        for path in paths:
+            top = path.split("/")[0]
+            name = path.split("/")[-1]
+            if top in ("Src", "Inc"):
+                phases.add("importApplication")
+                if name == "system_stm32%sxx.c" % hal:
+                    phases.add("importCMSIS")
+                elif name == "stm32%sxx_hal_conf.h" % hal:
+                    phases.add("importHAL")  # Enabled HAL modules
+                elif name in ("FreeRTOSConfig.h", "ffconf.h"):
+                    phases.add("importMiddlewares")  # FreeRTOS heap and FatFs code page
+            elif top == "Drivers":
+                phases.add("importCMSIS" if path.startswith("Drivers/CMSIS/") else "importHAL")
+            elif top == "startup":
+                phases.add("importCMSIS")
+            elif top == "Middlewares":
+                phases.add("importMiddlewares")
+            elif path == ".mxproject" or path.endswith(".ioc"):
+                if self.projectIndex.hasMiddlewares():
+                    phases.add("importMiddlewares")  # FreeRTOS heap
+            elif path == ".cproject" or top == "SW4STM32":
+                return None
+        return [phase for phase in self.IMPORT_PHASES if phase in phases]
+
+    def reimport(self, paths=None):
+        """Import again the CubeMX project after the files in 'paths' changed, running only the phases
+        reading them (all phases if 'paths' is None). The files imported by the other phases are kept, so
+        it requires the incremental mode. Returns the phases run"""
+        if paths is not None and any("/" not in path or path.startswith("Middlewares/") for path in paths):
+            # The project index (middlewares, top level folders, .ioc file) could be stale: scan it again
+            self.cubeMXProjectPath = self.cubemxinputpath
+        phases = self.affectedPhases(paths) if paths is not None else None
+        if phases == []:
+            return phases
+        if phases is None:
+            self.cubeMXProjectPath = self.cubemxinputpath  # Scan the CubeMX project again
+            phases = self.IMPORT_PHASES
+
+        self.stats = ImportStats()
+        if os.stat(os.path.join(self.eclipseprojectpath, ".cproject")).st_mtime != self.projectMtime:
+            self.runPhase("parseEclipseProjectFile")  # Modified outside the importer, e.g. by Eclipse
+        self.manifest.restart(phases if phases != self.IMPORT_PHASES else None)
+        self.runImport(phases)
+        return phases
+
+    def waitCopies(self, start):
+        """Wait for the copies submitted since 'start', sharing the elapsed wall time among the phases that
+        planned them in proportion to the time their copies took. Returns the elapsed time"""
+        self.copier.wait()
+        elapsed = time.time() - start
+        with self.stats.lock:
+            copyTimes, self.copyTimes = self.copyTimes, {}
+        busy = sum(copyTimes.values())
+        for phase, seconds in copyTimes.items():
+            self.stats.add(phase, "seconds", elapsed * seconds / busy if busy else 0)
+        return elapsed if busy else 0
+
+    def runPhase(self, name):
+        """Run the import phase with the given method name, measuring its wall time"""
+        self.plan.phase = name
+        start = time.time()
+        try:
+            getattr(self, name)()
+        finally:
+            self.stats.add(name, "seconds", time.time() - start)
+            self.plan.phase = None
+
+    def executePlan(self):
+        """Apply the operations planned by the import phases. In dryrun mode, the plan and its I/O cost are
+        only printed. The time spent applying each operation is accounted to the phase that planned it"""
+        self.plan.optimize(self)
+
+        if self.dryrun:
+            print(self.plan.describe())
+            return
+
+        self.importStamp().invalidate()
+        options = self.projectOptions
+        self.copyTimes = {}
+        applied = 0
+        copyStart = None
+        for op in self.plan.operations:
+            if op.kind != "copy" and copyStart is not None:
+                applied += self.waitCopies(copyStart)
+                copyStart = None
+            queries, nodesAdded = options.queries, options.nodesAdded
+            start = time.time()
+            if op.kind == "copy" and copyStart is None:
+                copyStart = start
+            op.apply(self)
+            if op.kind != "copy":
+                self.stats.add(op.phase, "seconds", time.time() - start)
+                applied += time.time() - start
+            if op.kind == "delete":
+                self.stats.add(op.phase, "filesDeleted", op.files)
+                self.stats.add(op.phase, "bytesDeleted", op.bytes)
+            elif op.kind == "xml-edit":
+                self.stats.add(op.phase, "queries", options.queries - queries)
+                self.stats.add(op.phase, "nodesAdded", options.nodesAdded - nodesAdded)
+        if copyStart is not None:
+            applied += self.waitCopies(copyStart)
+        self.stats.add("executePlan", "seconds", -applied)  # Already accounted to the phases
+
+        if self.incremental:
+            self.manifest.save()
+        self.logger.info("Applied %d planned operations" % len(self.plan.operations))
+        self.plan = ImportPlan()
+
+    def setIncremental(self, incremental):
+        """Enable incremental mode: only files changed since the last import are copied"""
+        self.incremental = incremental
+        if incremental:
+            self.manifest.load()
+            self.logger.debug("Running in incremental mode: %d files recorded by the last import" %
+                              len(self.manifest.previous))
+
+    def setJobs(self, jobs):
+        """Set the number of threads used to copy files inside the Eclipse project"""
+        self.copier.close()
+        self.copier = CopyEngine(jobs, self.copier.linkMode)
+
+    def setLinkMode(self, mode):
+        """Set how vendor files (HAL, CMSIS and Middlewares) are placed in the Eclipse project:
+        copied, hard-linked, reflinked or symlinked to the CubeMX project ones"""
+        if mode not in CopyEngine.LINK_MODES:
+            raise ValueError("Unknown link mode '%s'" % mode)
+        self.copier.linkMode = mode
+
+    def setSharedStore(self, store):
+        """Materialize vendor files (HAL, CMSIS and Middlewares) from a SharedStore"""
+        self.store = store
+
+    def storeVersion(self):
+        """The key of the HAL family and firmware version of the CubeMX project inside the shared store"""
+        return "%s-%s" % (self.HAL_TYPE, self.firmwareVersion())
+
+    def addSharedStoreReference(self):
+        """Record inside the shared store that this Eclipse project uses the current firmware version"""
+        if self.store is not None and not self.dryrun:
+            self.store.addReference(self.eclipseprojectpath, self.storeVersion())
+            self.logger.info("Vendor files shared through the store in '%s'" % self.store.root)
+
+    def importStamp(self):
+        """The ImportStamp of the inputs and options of this import"""
+        return ImportStamp(self.eclipseprojectpath, self.cubemxinputpath, ImportStamp.importOptions(
+            self.copier.linkMode, self.store.root if self.store is not None else None, self.halModulesMode,
+            self.pruneMiddlewares, self.buildFiles, self.unityBatches, self.firmwarepackage, self.minimalIncludes))
+
+    def saveImportStamp(self):
+        """Record the fingerprint of the inputs of this import, compared by checkProject()"""
         if not self.dryrun:
-            open(projectFile, "w+").write(xmlout)
+            self.importStamp().save()
+
+    def setHALModulesMode(self, mode):
+        """Set how HAL modules disabled in stm32XXxx_hal_conf.h are handled: 'all' imports every HAL
+        source, 'import' imports only the needed ones, 'exclude' imports all but excludes from the build
+        the ones not needed"""
+        if mode not in ("all", "import", "exclude"):
+            raise ValueError("Unknown HAL modules mode '%s'" % mode)
+        self.halModulesMode = mode
+
+    def setBuildFiles(self, enabled):
+        """Enable the generation of Ninja and CMake builds and of compile_commands.json after the import"""
+        self.buildFiles = enabled
+
+    def setMinimalIncludes(self, enabled):
+        """Keep only the include paths needed by the sources of the Eclipse project"""
+        self.minimalIncludes = enabled
+
+    def setUnityBatches(self, batches):
+        """Group the HAL sources and the ones of each middleware in the given number of unity files (0 disables it)"""
+        if batches < 0:
+            raise ValueError("The number of unity files can't be negative")
+        self.unityBatches = batches
+
+    def setPruneMiddlewares(self, prune):
+        """Enable the exclusion from the build of the FreeRTOS and FatFs files not used by the project"""
+        self.pruneMiddlewares = prune
 
     def setDryRun(self, dryrun):
         """Enable dryrun mode: it does't execute operations on projects"""
@@ -481,18 +3300,9 @@ exclude from build those uneeded codepage files (cc932.c, etc) not needed for yo
 
     def fixDeviceInclude(self):
         """Set the correct include file inside the cmsis device include if exists, this will work even if old naming was present"""
-        filename_in = os.path.join(self.eclipseprojectpath, "system/include/cmsis/cmsis_device.h")
-        filename_out = filename_in + '.tmp'
-        if os.path.isfile(filename_in):
-            with open(filename_out, "wt") as fout:
-                with open(filename_in, "rt") as fin:
-                    for line in fin:
-                        if re.search('^#include .*stm32.*\.h.*$', line):
-                            fout.write('#include "stm32%sxx.h"\n' % self.HAL_TYPE.lower())
-                        else:
-                            fout.write(line)
-            os.remove(filename_in)
-            os.rename(filename_out, filename_in)
+        self.patchFiles([PatchRule("system/include/cmsis/cmsis_device.h", r'^#include .*stm32.*\.h.*$',
+                                   '#include "stm32%sxx.h"' % self.HAL_TYPE.lower(), literal="stm32",
+                                   description="Fixed the device include in cmsis_device.h")])
 
 class InvalidCubeMXFolder(Exception):
     pass
@@ -502,28 +3312,329 @@ class InvalidEclipseFolder(Exception):
     pass
 
 
+class InvalidFirmwarePackage(Exception):
+    pass
+
+
 class InvalidSW4STM32Project(Exception):
     pass
 
 
+class InvalidBatchManifest(Exception):
+    pass
+
+
+def createImporter(eclipsePath, cubemxPath, dryrun=False, jobs=4, linkMode="copy", incremental=False, store=None,
+                   halModules="all", pruneMiddlewares=True, buildFiles=False, unityBatches=0, firmware=None,
+                   minimalIncludes=False):
+    """Create a CubeMXImporter for the given projects, with the options of importProject()"""
+    cubeImporter = CubeMXImporter()
+    cubeImporter.setDryRun(dryrun)
+    cubeImporter.setJobs(jobs)
+    cubeImporter.setLinkMode(linkMode)
+    if store is not None:
+        cubeImporter.setSharedStore(SharedStore(store or None))
+    cubeImporter.setHALModulesMode(halModules)
+    cubeImporter.setPruneMiddlewares(pruneMiddlewares)
+    cubeImporter.setBuildFiles(buildFiles)
+    cubeImporter.setUnityBatches(unityBatches)
+    cubeImporter.setMinimalIncludes(minimalIncludes)
+    cubeImporter.eclipseProjectPath = eclipsePath
+    cubeImporter.setIncremental(incremental)
+    if firmware is not None:
+        cubeImporter.setFirmwarePackage(firmware)
+    cubeImporter.cubeMXProjectPath = cubemxPath
+    return cubeImporter
+
+
+def checkProject(eclipsePath, cubemxPath, linkMode="copy", store=None, halModules="all", pruneMiddlewares=True,
+                 buildFiles=False, unityBatches=0, firmware=None, minimalIncludes=False, **options):
+    """Check if the Eclipse project was imported from the current content of the CubeMX project, by
+    the same importer version and with the same options, without parsing any project file. The other
+    options of importProject() don't change the result of the import, and are ignored"""
+    if store is not None:
+        store = store or SharedStore.defaultRoot()
+    return ImportStamp(eclipsePath, cubemxPath,
+                       ImportStamp.importOptions(linkMode, store, halModules, pruneMiddlewares, buildFiles,
+                                                 unityBatches, firmware, minimalIncludes)).isUpToDate()
+
+
+def importProject(eclipsePath, cubemxPath, dryrun=False, jobs=4, linkMode="copy", incremental=False, store=None,
+                  halModules="all", pruneMiddlewares=True, buildFiles=False, unityBatches=0, firmware=None,
+                  minimalIncludes=False, profile=None):
+    """Import a CubeMX generated project inside an existing Eclipse project, running all the import phases.
+    'store' is the path of the shared store of vendor files, if used. If 'buildFiles' is True, Ninja and
+    CMake builds and a compile_commands.json are generated from the Eclipse project settings. 'unityBatches'
+    is the number of unity files grouping the HAL and each middleware sources (0 to disable them). The
+    CubeMX project can be a folder or a zip or tar archive, and 'firmware' the STM32Cube firmware package
+    (archive or folder) HAL and CMSIS files are imported from. If 'minimalIncludes' is True, only the include
+    paths needed by the sources are kept. If 'profile' is given, the import runs under cProfile and its
+    statistics are dumped to that file"""
+    if profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return importProject(eclipsePath, cubemxPath, dryrun, jobs, linkMode, incremental, store, halModules,
+                                 pruneMiddlewares, buildFiles, unityBatches, firmware,
+                                 minimalIncludes)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile)
+
+    cubeImporter = createImporter(eclipsePath, cubemxPath, dryrun, jobs, linkMode, incremental, store, halModules,
+                                  pruneMiddlewares, buildFiles, unityBatches, firmware,
+                                  minimalIncludes)
+    try:
+        cubeImporter.runPhase("parseEclipseProjectFile")
+        cubeImporter.runImport()
+    finally:
+        cubeImporter.copier.close()
+        cubeImporter.sources.close()
+        if cubeImporter.store is not None:
+            cubeImporter.store.release()
+    cubeImporter.logger.info(cubeImporter.copier.summary())
+    return cubeImporter
+
+
+def createWatcher(path):
+    """Watch the CubeMX project with inotify, falling back to polling where it is not available"""
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError) as e:
+        logging.getLogger(__name__).info("Polling the CubeMX project for changes (%s)" % e)
+        return PollingWatcher(path)
+
+
+def watchProject(eclipsePath, cubemxPath, debounce=0.5, **options):
+    """Import the CubeMX project, then import it again every time CubeMX regenerates it, until interrupted.
+    The importer is kept in memory, and only the phases reading the changed files are run again. Changes
+    are collected until the CubeMX project is quiet for 'debounce' seconds"""
+    if SourceFiles.isArchive(cubemxPath):
+        raise ValueError("Only CubeMX projects extracted in a folder can be watched")
+    options["incremental"] = True
+    cubeImporter = createImporter(eclipsePath, cubemxPath, **options)
+    watcher = None
+    try:
+        cubeImporter.runPhase("parseEclipseProjectFile")
+        cubeImporter.runImport()
+        watcher = createWatcher(cubemxPath)
+        print("Watching '%s' for changes, press Ctrl+C to stop" % cubemxPath)
+        failed = False
+        while True:
+            changes = watcher.poll()
+            while True:
+                more = watcher.poll(debounce)  # CubeMX writes many files when regenerating the project
+                if more is not None and not more:
+                    break
+                changes = None if more is None or changes is None else changes | more
+
+            start = time.time()
+            try:
+                # After a failed import, the whole project is imported again
+                phases = cubeImporter.reimport(None if changes is None or failed else sorted(changes))
+                failed = False
+            except Exception as e:
+                # CubeMX may still be writing the project: keep watching, the next change triggers a new import
+                cubeImporter.logger.error("Import failed: %s" % e)
+                cubeImporter.plan = ImportPlan()
+                failed = True
+                continue
+            if phases:
+                print("Imported %d changed files in %.2fs (%s)" % (
+                    len(changes) if changes is not None else 0, time.time() - start, ", ".join(phases)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.close()
+        cubeImporter.copier.close()
+        cubeImporter.sources.close()
+        if cubeImporter.store is not None:
+            cubeImporter.store.release()
+    return cubeImporter
+
+
+def loadBatchManifest(path):
+    """Load the list of (eclipse_path, cubemx_path) pairs to import from a JSON, YAML or CSV file.
+    Relative paths are relative to the folder containing the manifest"""
+    ext = os.path.splitext(path)[1].lower()
+
+    with open(path) as f:
+        if ext == ".csv":
+            import csv
+            entries = list(csv.DictReader(f))
+        elif ext in (".yml", ".yaml"):
+            try:
+                import yaml
+            except ImportError:
+                raise InvalidBatchManifest("Reading YAML manifests requires the PyYAML library")
+            entries = yaml.safe_load(f)
+        else:
+            try:
+                entries = json.load(f)
+            except ValueError as e:
+                raise InvalidBatchManifest("Unable to parse '%s': %s" % (path, e))
+
+    if isinstance(entries, dict):
+        entries = entries.get("projects", [])
+
+    baseDir = os.path.dirname(os.path.abspath(path))
+    pairs = []
+    for entry in entries or []:
+        try:
+            pairs.append((os.path.join(baseDir, entry["eclipse_path"]), os.path.join(baseDir, entry["cubemx_path"])))
+        except (KeyError, TypeError):
+            raise InvalidBatchManifest("Every entry in '%s' needs an 'eclipse_path' and a 'cubemx_path'" % path)
+    return pairs
+
+
+def _importProjectJob(job):
+    """Run importProject() inside a worker process, turning any failure in a report entry"""
+    eclipsePath, cubemxPath, options = job
+    result = {"eclipse_path": eclipsePath, "cubemx_path": cubemxPath, "status": "ok", "error": None}
+    start = time.time()
+    try:
+        result["stats"] = importProject(eclipsePath, cubemxPath, **options).stats.toDict()
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    result["elapsed"] = time.time() - start
+    return result
+
+
+def importProjects(pairs, processes=None, **options):
+    """Import many (eclipse_path, cubemx_path) pairs on a pool of processes. A failing project
+    doesn't stop the others: a list of results with status and timing of every project is returned"""
+    jobs = [(eclipsePath, cubemxPath, options) for eclipsePath, cubemxPath in pairs]
+    if processes == 1 or len(jobs) <= 1:
+        return [_importProjectJob(job) for job in jobs]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_importProjectJob, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def printBatchReport(results):
+    """Print a summary table of a batch import"""
+    for result in results:
+        print("%-6s %8.2fs  %s <- %s" % (result["status"].upper(), result["elapsed"], result["eclipse_path"],
+                                           result["cubemx_path"]))
+        if result["error"]:
+            print("       %s" % result["error"])
+    failed = len([r for r in results if r["status"] != "ok"])
+    print("%d projects imported, %d failed, %.2fs total" % (len(results) - failed, failed,
+                                                            sum(r["elapsed"] for r in results)))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Import a CubeMX generated project inside an existing Eclipse project generated with the GNU ARM plugin')
 
-    parser.add_argument('eclipse_path', metavar='eclipse_dest_prj_path', type=str,
+    parser.add_argument('eclipse_path', metavar='eclipse_dest_prj_path', type=str, nargs='?',
                         help='eclipse destination project path')
 
-    parser.add_argument('cubemx_path', metavar='cubemx_src_prj_path', type=str,
-                        help='cube_mx source project path')
+    parser.add_argument('cubemx_path', metavar='cubemx_src_prj_path', type=str, nargs='?',
+                        help='cube_mx source project path, or a zip or tar archive containing it')
 
     parser.add_argument('-v', '--verbose', type=int, action='store',
                         help='Verbose level')
 
     parser.add_argument('--dryrun', action='store_true',
-                        help="Doesn't perform operations - for debug purpose")
+                        help="Doesn't perform operations, printing the planned ones and their I/O cost")
+
+    parser.add_argument('-j', '--jobs', type=int, action='store', default=4,
+                        help="Number of files copied in parallel (default: 4)")
+
+    parser.add_argument('--link-mode', choices=CopyEngine.LINK_MODES, default="copy",
+                        help="How HAL, CMSIS and Middlewares files are placed in the Eclipse project "
+                             "(falls back to copy when not supported by the filesystem)")
+
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only copy the files changed since the last import, keeping untouched ones")
+
+    parser.add_argument('--hal-modules', choices=("all", "import", "exclude"), default="all",
+                        help="Import all HAL sources (default), only the ones needed by the modules enabled in "
+                             "stm32XXxx_hal_conf.h, or all but exclude from the build the ones not needed")
+
+    parser.add_argument('--no-middlewares-pruning', action='store_true',
+                        help="Don't exclude from the build the FreeRTOS memory managers and ports, and the "
+                             "FatFs code pages not used by the project")
+
+    parser.add_argument('--build-files', action='store_true',
+                        help="Generate build.ninja, CMakeLists.txt and compile_commands.json for the arm-none-eabi "
+                             "toolchain from the Eclipse project settings")
+
+    parser.add_argument('--firmware', metavar='PACKAGE', type=str,
+                        help="Import HAL and CMSIS files from a STM32Cube firmware package (e.g. "
+                             "STM32Cube_FW_F4_V1.16.0.zip, or the folder where it is extracted)")
+
+    parser.add_argument('--unity-build', metavar='BATCHES', type=int, default=0,
+                        help="Compile the HAL sources and the ones of each middleware in BATCHES unity files, "
+                             "leaving out the sources whose static symbols or macros collide (default: 0, disabled)")
+
+    parser.add_argument('--minimal-includes', action='store_true',
+                        help="Keep only the include paths needed by the sources, following their #include "
+                             "directives, and print the unused ones")
+
+    parser.add_argument('--store', metavar='DIR', type=str, nargs='?', const="",
+                        help="Share HAL, CMSIS and Middlewares files among projects through a content addressed "
+                             "store (default: ~/.cache/cubemximporter)")
+
+    parser.add_argument('--store-gc', action='store_true',
+                        help="Remove from the store the firmware versions no longer used by any project, then exit")
+
+    parser.add_argument('--check', action='store_true',
+                        help="Exit with 0 if the Eclipse project is up to date with the CubeMX project and the "
+                             "given options, with 1 otherwise, without modifying anything")
+
+    parser.add_argument('--stats', action='store_true',
+                        help="Print the wall time and I/O counters of every import phase")
+
+    parser.add_argument('--stats-json', metavar='FILE', type=str,
+                        help="Write the wall time and I/O counters of every import phase as JSON to FILE")
+
+    parser.add_argument('--profile', metavar='FILE', type=str,
+                        help="Run the import under cProfile, dumping its statistics to FILE")
+
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running, importing the CubeMX project again every time it is regenerated")
+
+    parser.add_argument('--watch-debounce', metavar='SECONDS', type=float, default=0.5,
+                        help="Wait for the CubeMX project to be quiet for SECONDS before importing it (default: 0.5)")
+
+    parser.add_argument('--batch', metavar='MANIFEST', type=str,
+                        help="Import all the eclipse_path/cubemx_path pairs listed in a JSON, YAML or CSV file")
+
+    parser.add_argument('--batch-jobs', type=int, action='store', default=None,
+                        help="Number of projects imported in parallel in batch mode (default: number of CPUs)")
+
+    parser.add_argument('--batch-report', metavar='FILE', type=str,
+                        help="Write the batch import results as JSON to FILE")
 
     args = parser.parse_args()
 
+    if args.store_gc:
+        store = SharedStore(args.store or None)
+        print("Removed %d unused versions and %d objects from '%s'" % (store.collectGarbage() + (store.root,)))
+        sys.exit(0)
+
+    if args.batch is None and (args.eclipse_path is None or args.cubemx_path is None):
+        parser.error("both eclipse_dest_prj_path and cubemx_src_prj_path are required, unless --batch is used")
+
+    if args.check:
+        if args.batch is not None:
+            parser.error("--check can't be used with --batch")
+        upToDate = checkProject(args.eclipse_path, args.cubemx_path, linkMode=args.link_mode, store=args.store,
+                                halModules=args.hal_modules, pruneMiddlewares=not args.no_middlewares_pruning,
+                                buildFiles=args.build_files, unityBatches=args.unity_build, firmware=args.firmware,
+                                minimalIncludes=args.minimal_includes)
+        print("The Eclipse project is %s" % ("up to date" if upToDate else "out of date"))
+        sys.exit(0 if upToDate else 1)
+
     if args.verbose == 3:
         logging.basicConfig(level=logging.DEBUG)
     if args.verbose == 2:
@@ -531,17 +3642,32 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.ERROR)
 
-    cubeImporter = CubeMXImporter()
-    cubeImporter.setDryRun(args.dryrun)
-    cubeImporter.eclipseProjectPath = args.eclipse_path
-    cubeImporter.cubeMXProjectPath = args.cubemx_path
-    cubeImporter.parseEclipseProjectFile()
-    cubeImporter.deleteOriginalEclipseProjectFiles()
-    cubeImporter.importApplication()
-    cubeImporter.importHAL()
-    cubeImporter.importCMSIS()
-    cubeImporter.importMiddlewares()
-    cubeImporter.saveEclipseProjectFile()
-    cubeImporter.patchMEM_LDFile()
+    options = dict(dryrun=args.dryrun, jobs=args.jobs, linkMode=args.link_mode, incremental=args.incremental,
+                   store=args.store, halModules=args.hal_modules,
+                   pruneMiddlewares=not args.no_middlewares_pruning, buildFiles=args.build_files,
+                   unityBatches=args.unity_build, firmware=args.firmware, minimalIncludes=args.minimal_includes)
+
+    if args.batch is not None:
+        results = importProjects(loadBatchManifest(args.batch), args.batch_jobs, **options)
+        printBatchReport(results)
+        if args.batch_report:
+            with open(args.batch_report, "w") as f:
+                json.dump(results, f, indent=1)
+        sys.exit(1 if [r for r in results if r["status"] != "ok"] else 0)
+
+    if args.watch:
+        if args.dryrun:
+            parser.error("--watch can't be used with --dryrun")
+        if SourceFiles.isArchive(args.cubemx_path):
+            parser.error("--watch can't be used with an archived CubeMX project")
+        watchProject(args.eclipse_path, args.cubemx_path, args.watch_debounce, **options)
+        sys.exit(0)
+
+    cubeImporter = importProject(args.eclipse_path, args.cubemx_path, profile=args.profile, **options)
+    if args.stats:
+        print(cubeImporter.stats.table())
+    if args.stats_json:
+        with open(args.stats_json, "w") as f:
+            json.dump(cubeImporter.stats.toDict(), f, indent=1)
     # cubeImporter.addCIncludes(["../middlewares/freertos"])
     # cubeImporter.printEclipseProjectFile()